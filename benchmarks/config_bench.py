@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+#
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    Benchmarks for loading static kas configurations.
+
+    Generates synthetic configurations and measures how long kas needs to
+    load them, to resolve their includes, to create the repositories and
+    to write the bitbake configuration. The startup time of the kas command
+    line is measured as well. The results are written as JSON and can be
+    compared against the results of a previous run:
+
+      benchmarks/config_bench.py --output baseline.json
+      benchmarks/config_bench.py --baseline baseline.json
+
+    The comparison fails if a benchmark got slower than the threshold.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import functools
+import platform
+import tempfile
+import subprocess
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+sys.path.insert(0, TOPDIR)
+
+# pylint: disable=wrong-import-position
+from kas import __version__  # noqa: E402
+from kas.config import load_config  # noqa: E402
+from kas.includehandler import GlobalIncludes  # noqa: E402
+from kas.libcmds import WriteConfig  # noqa: E402
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+def _write_config(dirname, name, includes=(), repos=None, extra=None):
+    """
+        Writes a static configuration file in the yaml format.
+    """
+    lines = ['header:', '  version: "0.9"']
+    if includes:
+        lines.append('  includes:')
+        lines.extend('    - {}'.format(inc) for inc in includes)
+    if repos:
+        lines.append('repos:')
+        for (repo, layers) in repos:
+            lines.append('  {}:'.format(repo))
+            lines.append('    path: {}'.format(os.path.join(dirname, repo)))
+            if layers:
+                lines.append('    layers:')
+                lines.extend('      {}:'.format(layer) for layer in layers)
+    lines.append('local_conf_header:')
+    lines.append('  {}: |'.format(name.replace('.', '_')))
+    lines.append('    # {}'.format(name))
+    for (key, value) in (extra or {}).items():
+        lines.append('{}: {}'.format(key, value))
+    with open(os.path.join(dirname, name), 'w') as fds:
+        fds.write('\n'.join(lines) + '\n')
+
+
+def generate_deep(dirname, depth=100):
+    """
+        A chain of includes, every file includes the next one.
+    """
+    for i in range(depth):
+        includes = ['deep{}.yml'.format(i + 1)] if i + 1 < depth else []
+        _write_config(dirname, 'deep{}.yml'.format(i), includes,
+                      extra={'machine': 'machine{}'.format(i)})
+    return os.path.join(dirname, 'deep0.yml')
+
+
+def generate_wide(dirname, width=300):
+    """
+        One file that directly includes all others.
+    """
+    for i in range(width):
+        _write_config(dirname, 'wide{}.yml'.format(i),
+                      repos=[('repo{}'.format(i), [])])
+    _write_config(dirname, 'top.yml',
+                  ['wide{}.yml'.format(i) for i in range(width)])
+    return os.path.join(dirname, 'top.yml')
+
+
+def generate_diamond(dirname, levels=8, width=16):
+    """
+        Levels of files, every file includes two files of the next level,
+        so most files are reached on many paths.
+    """
+    for level in reversed(range(levels)):
+        for i in range(width):
+            includes = []
+            if level + 1 < levels:
+                includes = ['diamond{}_{}.yml'.format(level + 1, j % width)
+                            for j in [i, i + 1]]
+            _write_config(dirname, 'diamond{}_{}.yml'.format(level, i),
+                          includes, extra={'distro': 'distro{}'.format(i)})
+    _write_config(dirname, 'top.yml',
+                  ['diamond0_{}.yml'.format(i) for i in range(width)])
+    return os.path.join(dirname, 'top.yml')
+
+
+def generate_tree(dirname, files=500, fanout=3):
+    """
+        A tree of include files, every file includes the next `fanout`
+        files that are not included yet.
+    """
+    for i in range(files):
+        includes = ['tree{}.yml'.format(j)
+                    for j in range(fanout * i + 1, fanout * i + fanout + 1)
+                    if j < files]
+        _write_config(dirname, 'tree{}.yml'.format(i), includes,
+                      extra={'machine': 'machine{}'.format(i)})
+    return os.path.join(dirname, 'tree0.yml')
+
+
+def generate_dag(dirname):
+    """
+        Like diamond, but with 500 files on 25 levels. Merging every file
+        once per path would take forever here.
+    """
+    return generate_diamond(dirname, levels=25, width=20)
+
+
+def generate_repos(dirname, repos=300, layers=10):
+    """
+        A single file with many repositories with many layers each.
+    """
+    _write_config(dirname, 'top.yml',
+                  repos=[('repo{}'.format(i),
+                          ['meta-layer{}'.format(j) for j in range(layers)])
+                         for i in range(repos)])
+    return os.path.join(dirname, 'top.yml')
+
+
+SCENARIOS = [
+    ('deep', generate_deep),
+    ('wide', generate_wide),
+    ('diamond', generate_diamond),
+    ('tree', generate_tree),
+    ('dag', generate_dag),
+    ('repos', generate_repos),
+]
+
+
+def measure(func, repeat, setup=None):
+    """
+        Calls `func` `repeat` times and returns the fastest and the mean
+        duration in seconds. `setup` is called before every call of `func`
+        and not measured.
+    """
+    durations = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return {'min': min(durations), 'mean': sum(durations) / len(durations)}
+
+
+def run_scenario(name, generator, repeat):
+    """
+        Runs all benchmarks for a scenario and returns their results.
+    """
+    # pylint: disable=protected-access
+    workdir = tempfile.mkdtemp(prefix='kas-bench-')
+    try:
+        os.environ['KAS_WORK_DIR'] = workdir
+        os.makedirs(os.path.join(workdir, 'build', 'conf'))
+        top_file = generator(workdir)
+        cache_dir = os.path.join(workdir, '.kas_cache')
+        results = {}
+
+        def _clear_cache():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+        results['load_config.cold'] = measure(
+            lambda: load_config(top_file, None), repeat, _clear_cache)
+        results['load_config.warm'] = measure(
+            lambda: load_config(top_file, None), repeat)
+
+        results['get_config.cold'] = measure(
+            lambda: GlobalIncludes(top_file).get_config(), repeat)
+        handler = GlobalIncludes(top_file)
+        handler.get_config()
+        results['get_config.warm'] = measure(handler.get_config, repeat)
+
+        config = load_config(top_file, None)
+
+        def _invalidate_repos():
+            config._repo_dict_config = None
+
+        results['get_repo_dict.cold'] = measure(
+            config.get_repo_dict, repeat, _invalidate_repos)
+        results['get_repo_dict.warm'] = measure(config.get_repo_dict, repeat)
+
+        def _remove_conf():
+            for conf in ['bblayers.conf', 'local.conf']:
+                filename = os.path.join(config.build_dir, 'conf', conf)
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+        results['write_config.new'] = measure(
+            lambda: WriteConfig().execute(config), repeat, _remove_conf)
+        results['write_config.unchanged'] = measure(
+            lambda: WriteConfig().execute(config), repeat)
+
+        return {'{}.{}'.format(name, key): value
+                for (key, value) in results.items()}
+    finally:
+        shutil.rmtree(workdir)
+
+
+STARTUP_COMMANDS = [
+    ('version', ['--version']),
+    ('build_help', ['build', '--help']),
+]
+
+
+def run_startup(repeat):
+    """
+        Measures how long kas needs to run commands that do little more
+        than starting up, like printing its version.
+    """
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [TOPDIR, os.environ.get('PYTHONPATH')]))
+    results = {}
+    for (name, args) in STARTUP_COMMANDS:
+        run = functools.partial(subprocess.check_call,
+                                [sys.executable, '-m', 'kas'] + args,
+                                env=env, stdout=subprocess.DEVNULL)
+        # Fill the plugin index and the bytecode caches first
+        run()
+        results['startup.{}'.format(name)] = measure(run, repeat)
+    return results
+
+
+def compare(results, baseline, threshold, min_time):
+    """
+        Prints the results relative to the baseline and returns the names of
+        the benchmarks that are slower than `threshold` times the baseline.
+        Benchmarks that took less than `min_time` seconds in the baseline
+        are too noisy to be compared and only printed.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print('{:40} {:10.2f} ms (new)'
+                  .format(name, results[name]['min'] * 1000))
+            continue
+        if baseline[name]['min'] < min_time:
+            print('{:40} {:10.2f} ms {:10.2f} ms'
+                  .format(name, baseline[name]['min'] * 1000,
+                          results[name]['min'] * 1000))
+            continue
+        ratio = results[name]['min'] / baseline[name]['min']
+        print('{:40} {:10.2f} ms {:10.2f} ms {:7.2f}x'
+              .format(name, baseline[name]['min'] * 1000,
+                      results[name]['min'] * 1000, ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    """
+        Runs the benchmarks.
+    """
+    parser = argparse.ArgumentParser(
+        description='Benchmark loading of kas configurations')
+    parser.add_argument('-o', '--output',
+                        help='Write the results as JSON into this file')
+    parser.add_argument('-b', '--baseline',
+                        help='Compare the results with this JSON file')
+    parser.add_argument('-t', '--threshold', type=float, default=1.2,
+                        help='Fail if a benchmark takes longer than this '
+                             'factor times the baseline (default: 1.2)')
+    parser.add_argument('--min-time', type=float, default=0.001,
+                        help='Do not compare benchmarks that took less than '
+                             'this many seconds in the baseline '
+                             '(default: 0.001)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='Number of runs per benchmark, the fastest one '
+                             'is used for comparisons (default: 5)')
+    parser.add_argument('-s', '--scenario', action='append',
+                        choices=[name for (name, _) in SCENARIOS] +
+                        ['startup'],
+                        help='Only run this scenario, can be given more '
+                             'than once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {}
+    for (name, generator) in SCENARIOS:
+        if args.scenario and name not in args.scenario:
+            continue
+        results.update(run_scenario(name, generator, args.repeat))
+    if not args.scenario or 'startup' in args.scenario:
+        results.update(run_startup(args.repeat))
+
+    output = {
+        'kas_version': __version__,
+        'python_version': platform.python_version(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fds:
+            json.dump(output, fds, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as fds:
+            baseline = json.load(fds)['results']
+        regressions = compare(results, baseline, args.threshold,
+                              args.min_time)
+        if regressions:
+            print('Slower than {}x the baseline: {}'
+                  .format(args.threshold, ', '.join(regressions)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    Compares the include handling of kas with the original implementation,
+    which walked and merged a file once for every path on which it is
+    included.
+
+    Generates random include graphs with random configurations and checks
+    that GlobalIncludes.get_config returns the same values and missing
+    repos as the original implementation. If no file is included more than
+    once, the order of the keys has to be the same as well:
+
+      benchmarks/include_check.py --graphs 1000 --seed 42
+
+    The original implementation is exponential for shared includes, so the
+    graphs are kept small.
+"""
+
+import os
+import sys
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import functools
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+# pylint: disable=wrong-import-position
+from kas.includehandler import (GlobalIncludes, IncludeException,  # noqa: E402
+                                load_config)
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+KEYS = ['a', 'b', 'c', 'd', 'e']
+
+
+def original_get_config(top_file, repos):
+    """
+        The include handling of kas before files were merged only once.
+    """
+    def _internal_include_handler(filename):
+        missing_repos = []
+        configs = []
+        current_config = load_config(filename)
+        header = current_config.get('header', {})
+        for include in header.get('includes', []):
+            if isinstance(include, str):
+                includefile = os.path.abspath(
+                    os.path.join(os.path.dirname(filename), include))
+            else:
+                includedir = repos.get(include['repo'], None)
+                if includedir is None:
+                    missing_repos.append(include['repo'])
+                    continue
+                includefile = os.path.abspath(
+                    os.path.join(includedir, include['file']))
+            (cfg, rep) = _internal_include_handler(includefile)
+            configs.extend(cfg)
+            missing_repos.extend(rep)
+        configs.append(current_config)
+        return (configs, missing_repos)
+
+    def _internal_dict_merge(dest, upd):
+        if (not isinstance(dest, collections.Mapping)) \
+                or (not isinstance(upd, collections.Mapping)):
+            raise IncludeException('Cannot merge using non-dict')
+        dest = collections.OrderedDict(dest)
+        for key in upd:
+            val = upd[key]
+            dest_subkey = dest.get(key, None)
+            if isinstance(dest_subkey, collections.Mapping) \
+                    and isinstance(val, collections.Mapping):
+                dest[key] = _internal_dict_merge(dest_subkey, val)
+            else:
+                dest[key] = val
+        return dest
+
+    (configs, missing_repos) = _internal_include_handler(top_file)
+    config = functools.reduce(_internal_dict_merge, configs)
+    return (config, list(collections.OrderedDict.fromkeys(missing_repos)))
+
+
+def _random_value(rnd, depth):
+    """
+        Returns a random scalar or mapping, so that files override each
+        other with values of different types.
+    """
+    if depth > 2 or rnd.random() < 0.5:
+        return rnd.choice([rnd.randint(0, 9), 'value{}'.format(rnd.randint(
+            0, 9)), None])
+    return collections.OrderedDict(
+        (key, _random_value(rnd, depth + 1))
+        for key in rnd.sample(KEYS, rnd.randint(1, 3)))
+
+
+def generate_graph(dirname, rnd, files):
+    """
+        Writes a random include graph of `files` files into `dirname`. File
+        i only includes files with a higher number, some of them from
+        repos. Returns the top file, the repos that are available and
+        whether any file is included more than once.
+    """
+    repos = {'repo0': os.path.join(dirname, 'repo0'),
+             'repo1': os.path.join(dirname, 'repo1')}
+    for path in repos.values():
+        os.makedirs(path)
+    locations = [rnd.choice([None, 'repo0', 'repo1']) if i else None
+                 for i in range(files)]
+    paths = [os.path.join(repos[location] if location else dirname,
+                          'file{}.json'.format(i))
+             for (i, location) in enumerate(locations)]
+    parents = [0] * files
+    for i in range(files):
+        includes = []
+        for j in rnd.sample(range(i + 1, files),
+                            rnd.randint(0, min(3, files - i - 1))):
+            parents[j] += 1
+            if locations[j] and rnd.random() < 0.7:
+                includes.append({'repo': locations[j],
+                                 'file': os.path.basename(paths[j])})
+            else:
+                includes.append(os.path.relpath(
+                    paths[j], os.path.dirname(paths[i])))
+        if rnd.random() < 0.2:
+            includes.append({'repo': 'missing{}'.format(rnd.randint(0, 2)),
+                             'file': 'file.json'})
+        config = collections.OrderedDict()
+        config['header'] = {'version': '0.9', 'includes': includes}
+        for key in rnd.sample(KEYS, rnd.randint(1, 4)):
+            config[key] = _random_value(rnd, 0)
+        with open(paths[i], 'w') as fds:
+            json.dump(config, fds)
+    shared = any(count > 1 for count in parents)
+    return (paths[0], repos, shared)
+
+
+def _plain(value):
+    """
+        Converts all mappings to dicts, which compare equal independent of
+        the order of their keys.
+    """
+    if isinstance(value, collections.Mapping):
+        return {key: _plain(val) for (key, val) in value.items()}
+    return value
+
+
+def check_graph(rnd, files):
+    """
+        Compares both implementations for one random graph. Returns an
+        error message or None.
+    """
+    workdir = tempfile.mkdtemp(prefix='kas-include-check-')
+    try:
+        (top_file, repos, shared) = generate_graph(workdir, rnd, files)
+        (expected, expected_missing) = original_get_config(top_file, repos)
+        (config, missing) = GlobalIncludes(top_file).get_config(repos=repos)
+        if _plain(config) != _plain(expected):
+            return 'different values:\n  {}\n  {}'.format(
+                json.dumps(expected), json.dumps(config))
+        if not shared and json.dumps(config) != json.dumps(expected):
+            return 'different order:\n  {}\n  {}'.format(
+                json.dumps(expected), json.dumps(config))
+        if missing != expected_missing:
+            return 'different missing repos: {} {}'.format(
+                expected_missing, missing)
+        return None
+    finally:
+        shutil.rmtree(workdir)
+
+
+def main():
+    """
+        Runs the comparison.
+    """
+    parser = argparse.ArgumentParser(
+        description='Compare the include handling with the original one')
+    parser.add_argument('-g', '--graphs', type=int, default=300,
+                        help='Number of random graphs (default: 300)')
+    parser.add_argument('-f', '--files', type=int, default=10,
+                        help='Maximum number of files per graph '
+                             '(default: 10)')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='Seed of the first graph (default: 0)')
+    args = parser.parse_args()
+
+    failures = 0
+    for seed in range(args.seed, args.seed + args.graphs):
+        rnd = random.Random(seed)
+        error = check_graph(rnd, rnd.randint(1, args.files))
+        if error:
+            failures += 1
+            print('Graph with seed {}: {}'.format(seed, error))
+
+    print('{} of {} graphs differ'.format(failures, args.graphs))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
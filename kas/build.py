@@ -24,12 +24,15 @@
 """
 
 import os
+import logging
 from .config import load_config
+from .trace import trace_span
 from .libkas import find_program, run_cmd
 from .libcmds import (Macro, Command, SetupDir, SetupProxy,
                       CleanupSSHAgent, SetupSSHAgent, SetupEnviron,
                       WriteConfig, SetupHome, ReposFetch,
-                      ReposCheckout)
+                      ReposCheckout, add_common_arguments,
+                      apply_common_arguments)
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
@@ -54,6 +57,22 @@ class Build:
         bld_psr.add_argument('--skip',
                              help='Skip build steps',
                              default=[])
+        add_common_arguments(bld_psr)
+        bld_psr.add_argument('-j', '--jobs',
+                             help='Maximum number of repositories that are '
+                                  'fetched in parallel (default: '
+                                  '$KAS_MAX_JOBS or the number of CPUs)',
+                             type=int)
+        bld_psr.add_argument('--force',
+                             help='Run all steps, even those whose inputs '
+                                  'did not change since they last '
+                                  'completed',
+                             action='store_true')
+        bld_psr.add_argument('--pipeline',
+                             help='Check out each repository as soon as it '
+                                  'is fetched instead of waiting for all '
+                                  'fetches to complete',
+                             action='store_true')
 
     def run(self, args):
         """
@@ -64,7 +83,12 @@ class Build:
         if args.cmd != 'build':
             return False
 
-        cfg = load_config(args.config, args.target)
+        if args.jobs:
+            os.environ['KAS_MAX_JOBS'] = str(args.jobs)
+        apply_common_arguments(args)
+
+        with trace_span('load_config', 'command'):
+            cfg = load_config(args.config, args.target)
 
         macro = Macro()
 
@@ -75,8 +99,9 @@ class Build:
         if 'SSH_PRIVATE_KEY' in os.environ:
             macro.add(SetupSSHAgent())
 
-        macro.add(ReposFetch())
-        macro.add(ReposCheckout())
+        pipeline = args.pipeline and pipeline_possible(cfg, args.skip)
+        macro.add(ReposFetch(pipeline))
+        macro.add(ReposCheckout(pipeline))
         macro.add(SetupEnviron())
 
         macro.add(WriteConfig())
@@ -88,11 +113,29 @@ class Build:
         if 'SSH_PRIVATE_KEY' in os.environ:
             macro.add(CleanupSSHAgent())
 
-        macro.run(cfg, args.skip)
+        macro.run(cfg, args.skip, args.force)
 
         return True
 
 
+def pipeline_possible(config, skip):
+    """
+        Returns True if fetching and checkout of the repos can be pipelined
+        without changing the order in which the user hooks are executed.
+    """
+    if 'repos_fetch' in skip or 'repos_checkout' in skip:
+        return False
+
+    for hook in ['repos_fetch', 'repos_fetch_append',
+                 'repos_checkout_prepend', 'repos_checkout']:
+        if config.has_hook(hook):
+            logging.info('Not pipelining repos_fetch and repos_checkout '
+                         'because the hook %s is defined', hook)
+            return False
+
+    return True
+
+
 class BuildCommand(Command):
     """
         Implement the bitbake build step.
@@ -112,4 +155,4 @@ class BuildCommand(Command):
         # Start bitbake build of image
         bitbake = find_program(config.environ['PATH'], 'bitbake')
         run_cmd([bitbake, '-k', config.get_bitbake_target(), '-c', self.task],
-                env=config.environ, cwd=config.build_dir)
+                env=config.environ, cwd=config.build_dir, capture=False)
@@ -0,0 +1,138 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module writes the output of the commands executed by kas into
+    compressed per-command log files.
+"""
+
+import io
+import os
+import time
+import gzip
+import logging
+
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+class CommandLog:
+    """
+        A compressed log file that records the output of one command.
+        Every line is prefixed with the number of seconds since the start
+        of the command and the stream it was received on.
+    """
+
+    def __init__(self, filename, cmdstr, cwd):
+        self.filename = filename
+        self.start = time.time()
+        if filename.endswith('.zst'):
+            raw = open(filename, 'wb')
+            writer = zstandard.ZstdCompressor().stream_writer(raw)
+            self._file = io.TextIOWrapper(writer, encoding='utf-8')
+        else:
+            self._file = gzip.open(filename, 'wt', compresslevel=6,
+                                   encoding='utf-8')
+        self._file.write('# started: {}\n'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(self.start))))
+        self._file.write('# cwd: {}\n'.format(cwd))
+        self._file.write('# command: {}\n'.format(cmdstr))
+
+    def write(self, stream, line):
+        """
+            Writes a line received on `stream` ('stdout' or 'stderr').
+        """
+        self._file.write('{:10.3f} {} {}'.format(time.time() - self.start,
+                                                 stream, line))
+        if not line.endswith('\n'):
+            self._file.write('\n')
+
+    def close(self, retc):
+        """
+            Records the return code of the command and closes the file.
+        """
+        self._file.write('# finished: return code {} after {:.3f}s\n'
+                         .format(retc, time.time() - self.start))
+        self._file.close()
+
+
+class CommandLogDir:
+    """
+        Creates the log files of all commands in a directory. The files are
+        named after the step of the kas macro that was running when the
+        command was started, and numbered in the order the commands
+        started.
+    """
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.step = 'load_config'
+        self.count = 0
+        self.suffix = '.log.zst' if HAVE_ZSTD else '.log.gz'
+        os.makedirs(self.path, exist_ok=True)
+
+    def open(self, cmdstr, cwd):
+        """
+            Returns a new CommandLog for the command.
+        """
+        self.count += 1
+        filename = os.path.join(self.path, '{:04d}-{}{}'.format(
+            self.count, self.step, self.suffix))
+        logging.debug('Logging output of "%s" to %s', cmdstr, filename)
+        return CommandLog(filename, cmdstr, cwd)
+
+
+_LOG_DIR = None
+
+
+def set_log_dir(path):
+    """
+        Enables writing the command log files into `path`.
+    """
+    # pylint: disable=global-statement
+
+    global _LOG_DIR
+    _LOG_DIR = CommandLogDir(path)
+
+
+def set_step(name):
+    """
+        Sets the name of the step that runs the next commands.
+    """
+    if _LOG_DIR:
+        _LOG_DIR.step = name
+
+
+def open_command_log(cmdstr, cwd):
+    """
+        Returns a CommandLog for the command or None if no log directory
+        is set.
+    """
+    if _LOG_DIR:
+        return _LOG_DIR.open(cmdstr, cwd)
+    return None
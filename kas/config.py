@@ -25,8 +25,10 @@
 
 import os
 import sys
+import time
 import logging
 import errno
+import collections
 
 try:
     from distro import id as get_distro_id
@@ -42,13 +44,24 @@ except ImportError:
         # pylint: disable=deprecated-method
         return platform.dist()[0]
 
-from .repos import Repo
-from .libkas import run_cmd, repo_fetch, repo_checkout
+from .repos import Repo, CLONE_MODES
+from .mirrors import parse_size
+from .repostate import RepoStateCache
+from .gitrefs import find_toplevel
+from .libkas import run_cmd, repos_fetch
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
 
+def _env_flag(name):
+    """
+        Returns True if the environment variable `name` is set to a value
+        that means 'yes'.
+    """
+    return os.environ.get(name, '').lower() in ['1', 'y', 'yes', 'true']
+
+
 class Config:
     """
         This is an abstract class, that defines the interface of the
@@ -58,6 +71,7 @@ class Config:
         self.__kas_work_dir = os.environ.get('KAS_WORK_DIR', os.getcwd())
         self.environ = {}
         self._config = {}
+        self._repo_state = None
 
     @property
     def build_dir(self):
@@ -73,6 +87,22 @@ class Config:
         """
         return self.__kas_work_dir
 
+    @property
+    def cache_dir(self):
+        """
+            The path of the directory where kas keeps data between runs.
+        """
+        return os.path.join(self.__kas_work_dir, '.kas_cache')
+
+    def get_repo_state(self):
+        """
+            Returns the cache of the repository states.
+        """
+        if self._repo_state is None:
+            self._repo_state = RepoStateCache(
+                os.path.join(self.cache_dir, 'repo_state.json'))
+        return self._repo_state
+
     def setup_environ(self):
         """
             Sets the environment variables for process that are
@@ -99,6 +129,42 @@ class Config:
 
         return os.environ.get('KAS_REPO_REF_DIR', None)
 
+    def get_repo_ref_dir_managed(self):
+        """
+            Returns True if kas creates and updates the repository references
+            itself.
+        """
+        # pylint: disable=no-self-use
+
+        return _env_flag('KAS_REPO_REF_DIR_MANAGED')
+
+    def get_repo_ref_dir_max_size(self):
+        """
+            The size in bytes up to which the managed repository references
+            may grow or None if there is no limit.
+        """
+        # pylint: disable=no-self-use
+
+        size = os.environ.get('KAS_REPO_REF_DIR_MAX_SIZE', None)
+        return parse_size(size) if size else None
+
+    def is_offline(self):
+        """
+            Returns True if kas must not access the network.
+        """
+        # pylint: disable=no-self-use
+
+        return _env_flag('KAS_OFFLINE')
+
+    def get_max_jobs(self):
+        """
+            The maximum number of repositories that are fetched in parallel.
+        """
+        # pylint: disable=no-self-use
+
+        return max(int(os.environ.get('KAS_MAX_JOBS', 0)) or
+                   os.cpu_count() or 1, 1)
+
     def get_proxy_config(self):
         """
             Returns the proxy settings
@@ -141,6 +207,14 @@ class Config:
 
         pass
 
+    def has_hook(self, fname):
+        """
+            Returns True if a hook called `fname` is defined.
+        """
+        # pylint: disable=no-self-use,unused-argument
+
+        return False
+
     def get_bitbake_target(self):
         """
             Return the bitbake target
@@ -231,6 +305,9 @@ class ConfigPython(Config):
         except KeyError:
             return None
 
+    def has_hook(self, fname):
+        return fname in self._config
+
     def create_config(self, target):
         """
             Sets the configuration for `target`
@@ -314,9 +391,11 @@ class ConfigStatic(Config):
         from .includehandler import GlobalIncludes, IncludeException
         super().__init__()
         self._config = {}
+        self._repo_dict = None
+        self._repo_dict_config = None
         self.setup_environ()
         self.filename = os.path.abspath(filename)
-        self.handler = GlobalIncludes(self.filename)
+        self.handler = GlobalIncludes(self.filename, self.cache_dir)
         complete = False
         repos = {}
         missing_repos_old = []
@@ -330,9 +409,11 @@ class ConfigStatic(Config):
             if missing_repos:
                 complete = False
                 repo_dict = self.get_repo_dict()
-                for repo in missing_repos:
-                    repo_fetch(self, repo_dict[repo])
-                    repo_checkout(self, repo_dict[repo])
+                repos_fetch(self,
+                            [repo_dict[repo] for repo
+                             in collections.OrderedDict.fromkeys(
+                                 missing_repos)],
+                            checkout=True)
                 repos = {r: repo_dict[r].path for r in repo_dict}
 
     def get_repos(self):
@@ -346,34 +427,55 @@ class ConfigStatic(Config):
             Returns a dictionary containing the repositories with
             their name (as it is defined in the config file) as key
             and the `Repo` instances as value.
+
+            The `Repo` instances are created once and reused until the
+            merged configuration is replaced.
+        """
+        if self._repo_dict_config is not self._config:
+            self._repo_dict = self._create_repo_dict()
+            self._repo_dict_config = self._config
+        return dict(self._repo_dict)
+
+    def _get_toplevel(self, path):
+        """
+            Returns the top level directory of the work tree at `path`.
+        """
+        toplevel = find_toplevel(path)
+        if toplevel is None:
+            (_, output) = run_cmd(['/usr/bin/git', 'rev-parse',
+                                   '--show-toplevel'],
+                                  cwd=path, env=self.environ)
+            toplevel = output.strip()
+        return toplevel
+
+    def _create_repo_dict(self):
+        """
+            Creates the `Repo` instances from the merged configuration.
         """
         repo_config_dict = self._config.get('repos', {})
+        repo_defaults = self._config.get('defaults', {}).get('repos', {})
         repo_dict = {}
         for repo in repo_config_dict:
 
-            repo_config_dict[repo] = repo_config_dict[repo] or {}
-            layers_dict = repo_config_dict[repo].get('layers', {})
+            repo_config = repo_config_dict[repo] or {}
+            layers_dict = repo_config.get('layers', {})
             layers = list(filter(lambda x, laydict=layers_dict:
                                  str(laydict[x]).lower() not in
                                  ['disabled', 'excluded', 'n', 'no', '0',
                                   'false'],
                                  layers_dict))
-            url = repo_config_dict[repo].get('url', None)
-            name = repo_config_dict[repo].get('name', repo)
-            refspec = repo_config_dict[repo].get('refspec', None)
-            path = repo_config_dict[repo].get('path', None)
+            url = repo_config.get('url', None)
+            name = repo_config.get('name', repo)
+            refspec = repo_config.get('refspec', None)
+            path = repo_config.get('path', None)
+            (clone_mode, clone_depth) = _get_clone_settings(
+                repo, repo_config, repo_defaults)
 
             if url is None:
                 # No git operation on repository
                 if path is None:
                     # In-tree configuration
-                    path = os.path.dirname(self.filename)
-                    (_, output) = run_cmd(['/usr/bin/git',
-                                           'rev-parse',
-                                           '--show-toplevel'],
-                                          cwd=path,
-                                          env=self.environ)
-                    path = output.strip()
+                    path = self._get_toplevel(os.path.dirname(self.filename))
 
                 url = path
                 rep = Repo(url=url,
@@ -385,17 +487,41 @@ class ConfigStatic(Config):
                 rep = Repo(url=url,
                            path=path,
                            refspec=refspec,
-                           layers=layers)
+                           layers=layers,
+                           clone_mode=clone_mode,
+                           clone_depth=clone_depth)
             repo_dict[repo] = rep
         return repo_dict
 
 
+def _get_clone_settings(repo, repo_config, repo_defaults):
+    """
+        Returns the validated clone mode and depth of a repo.
+    """
+    clone_mode = repo_config.get('clone', repo_defaults.get('clone', 'full'))
+    clone_depth = repo_config.get('depth', repo_defaults.get('depth', 1))
+    if clone_mode not in CLONE_MODES:
+        logging.error('Clone mode of repo %s has to be one of %s: %s',
+                      repo, ', '.join(CLONE_MODES), clone_mode)
+        sys.exit(1)
+    try:
+        clone_depth = int(clone_depth)
+        if clone_depth < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        logging.error('Clone depth of repo %s has to be a positive number: '
+                      '%s', repo, clone_depth)
+        sys.exit(1)
+    return (clone_mode, clone_depth)
+
+
 def load_config(filename, target):
     """
         Return configuration generated from `filename`.
     """
     # pylint: disable=redefined-variable-type
 
+    start = time.monotonic()
     (_, ext) = os.path.splitext(filename)
     if ext == '.py':
         cfg = ConfigPython(filename, target)
@@ -405,4 +531,7 @@ def load_config(filename, target):
         logging.error('Config file extenstion not recognized')
         sys.exit(1)
 
+    logging.debug('Loaded configuration %s in %.1f ms', filename,
+                  (time.monotonic() - start) * 1000)
+
     return cfg
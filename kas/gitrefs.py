@@ -0,0 +1,132 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module reads the HEAD and the references of git repositories
+    without starting git. Everything it cannot resolve is reported as None,
+    so that the caller can fall back to git.
+"""
+
+import os
+import re
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+_OBJECT_ID = re.compile(r'^[0-9a-f]{40}([0-9a-f]{24})?$')
+
+# Maximum length of a chain of symbolic references
+_MAX_SYMREF_DEPTH = 5
+
+
+def _read_file(filename):
+    try:
+        with open(filename) as fds:
+            return fds.read().strip()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+
+def find_git_dir(path):
+    """
+        Returns the git directory of the work tree in `path`. This follows
+        '.git' files as they are used by worktrees and submodules.
+    """
+    dotgit = os.path.join(path, '.git')
+    if os.path.isdir(dotgit):
+        return dotgit
+    content = _read_file(dotgit)
+    if content and content.startswith('gitdir: '):
+        gitdir = os.path.join(path, content[len('gitdir: '):])
+        if os.path.isdir(gitdir):
+            return os.path.normpath(gitdir)
+    return None
+
+
+def get_common_dir(gitdir):
+    """
+        Returns the directory that holds the references shared by all
+        worktrees of the repository.
+    """
+    commondir = _read_file(os.path.join(gitdir, 'commondir'))
+    if commondir:
+        return os.path.normpath(os.path.join(gitdir, commondir))
+    return gitdir
+
+
+def find_toplevel(path):
+    """
+        Returns the top level directory of the work tree that contains
+        `path`, like `git rev-parse --show-toplevel`.
+    """
+    path = os.path.realpath(path)
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path if find_git_dir(path) else None
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _packed_ref(commondir, ref):
+    content = _read_file(os.path.join(commondir, 'packed-refs'))
+    if not content:
+        return None
+    for line in content.splitlines():
+        if line.startswith(('#', '^')):
+            continue
+        (objid, _, name) = line.partition(' ')
+        if name == ref:
+            return objid
+    return None
+
+
+def resolve_ref(gitdir, ref):
+    """
+        Returns the object id `ref` points to, e.g. 'HEAD' or
+        'refs/heads/master', following symbolic references.
+    """
+    commondir = get_common_dir(gitdir)
+    for _ in range(_MAX_SYMREF_DEPTH):
+        # HEAD and other pseudo refs are per worktree, refs/ are shared
+        if ref.startswith('refs/'):
+            content = _read_file(os.path.join(commondir, ref))
+            if content is None:
+                content = _packed_ref(commondir, ref)
+        else:
+            content = _read_file(os.path.join(gitdir, ref))
+        if content is None:
+            return None
+        if not content.startswith('ref: '):
+            return content if _OBJECT_ID.match(content) else None
+        ref = content[len('ref: '):]
+    return None
+
+
+def resolve_head(path):
+    """
+        Returns the object id of HEAD of the work tree in `path`.
+    """
+    gitdir = find_git_dir(path)
+    if gitdir is None:
+        return None
+    return resolve_ref(gitdir, 'HEAD')
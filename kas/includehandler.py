@@ -27,8 +27,11 @@
 
 import os
 import sys
+import time
+import marshal
+import hashlib
+import tempfile
 import collections
-import functools
 import logging
 from distutils.version import StrictVersion
 
@@ -38,24 +41,99 @@ __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
 
-def load_config(filename):
+def load_config(filename, cache_dir=None):
     """
         Load the configuration file and test if version is supported.
+
+        If `cache_dir` is given, the parsed and checked configuration is
+        stored there and reused as long as the file does not change.
     """
+    start = time.monotonic()
     (_, ext) = os.path.splitext(filename)
+    if ext not in ['.json', '.yml']:
+        logging.error('Config file extension not recognized: %s',
+                      filename)
+        sys.exit(1)
+
+    with open(filename, 'rb') as fds:
+        data = fds.read()
+    stat = os.stat(filename)
+    key = {
+        'path': os.path.abspath(filename),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'hash': hashlib.sha256(data).hexdigest(),
+        'version': __version__,
+    }
+
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(
+            cache_dir, 'config',
+            hashlib.sha256(key['path'].encode()).hexdigest() + '.marshal')
+        config = _load_cached_config(cache_file, key)
+        if config is not None:
+            logging.debug('Loaded %s from cache in %.1f ms', filename,
+                          (time.monotonic() - start) * 1000)
+            return config
+
+    config = _parse_config(filename, ext, data)
+
+    if cache_file:
+        _store_cached_config(cache_file, key, config)
+    logging.debug('Parsed %s in %.1f ms', filename,
+                  (time.monotonic() - start) * 1000)
+
+    return config
+
+
+def _load_cached_config(cache_file, key):
+    """
+        Returns the configuration stored in `cache_file` if it was stored
+        with the same `key`, None otherwise. The cache directory may be
+        restored from untrusted sources, so it only contains plain data
+        and every file that cannot be read is ignored.
+    """
+    # pylint: disable=broad-except
+    try:
+        with open(cache_file, 'rb') as fds:
+            (cached_key, config) = marshal.load(fds)
+        if cached_key != key:
+            return None
+    except Exception:
+        return None
+    return config
+
+
+def _store_cached_config(cache_file, key, config):
+    """
+        Atomically stores `config` together with its `key` in `cache_file`.
+        Configurations that contain other than the basic types, like dates
+        in YAML files, are not stored.
+    """
+    try:
+        data = marshal.dumps((key, config))
+    except ValueError:
+        return
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    (tmp_fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+    with os.fdopen(tmp_fd, 'wb') as fds:
+        fds.write(data)
+    os.replace(tmpname, cache_file)
+
+
+def _parse_config(filename, ext, data):
+    """
+        Parses the content of a configuration file and checks its version.
+    """
     config = None
     if ext == '.json':
         import json
-        with open(filename, 'rb') as fds:
-            config = json.load(fds)
-    elif ext == '.yml':
-        import yaml
-        with open(filename, 'rb') as fds:
-            config = yaml.safe_load(fds)
+        config = json.loads(data.decode())
     else:
-        logging.error('Config file extension not recognized: %s',
-                      filename)
-        sys.exit(1)
+        import yaml
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+        config = yaml.load(data, Loader=loader)
 
     file_version_string = config.get('header', {}).get('version', None)
 
@@ -142,10 +220,40 @@ class GlobalIncludes(IncludeHandler):
         current config file otherwise its relative to the repository path.
 
         The includes are read and merged depth first from top to buttom.
+        A file that is reached on more than one path is merged only once,
+        at the position of its last occurrence.
+
+        Parsed files are memoized per instance, so that calling
+        `get_config` again after fetching missing repos only parses the
+        files that were not seen or changed since the previous call.
     """
 
+    def __init__(self, top_file, cache_dir=None):
+        super().__init__(top_file)
+        self.cache_dir = cache_dir
+        self._file_cache = {}
+
+    def _load_config(self, filename):
+        """
+            Returns the parsed content of `filename`, reusing the result of
+            a previous call as long as the file was not modified.
+        """
+        stat = os.stat(filename)
+        key = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        cached = self._file_cache.get(filename)
+        if cached and cached[0] == key:
+            return cached[1]
+        config = load_config(filename, self.cache_dir)
+        self._file_cache[filename] = (key, config)
+        return config
+
     def get_config(self, repos=None):
         repos = repos or {}
+        # The include graph, every file is loaded and its includes are
+        # resolved only once, no matter on how many paths it is reached:
+        nodes = {}
+        in_progress = set()
+        missing_repos = []
 
         def _internal_include_handler(filename):
             """
@@ -173,94 +281,142 @@ class GlobalIncludes(IncludeHandler):
             the current file overwrites every include. (evaluation depth first
             and from top to buttom)
             """
-            missing_repos = []
-            configs = []
-            current_config = load_config(filename)
+            if filename in nodes:
+                return
+            if filename in in_progress:
+                raise IncludeException('Recursive include of {}'
+                                       .format(filename))
+            in_progress.add(filename)
+
+            includes = []
+            current_config = self._load_config(filename)
             if not isinstance(current_config, collections.Mapping):
                 raise IncludeException('Configuration file does not contain a '
                                        'dictionary as base type')
             header = current_config.get('header', {})
 
             for include in header.get('includes', []):
-                if isinstance(include, str):
-                    includefile = ''
-                    if include.startswith(os.path.pathsep):
-                        includefile = include
-                    else:
-                        includefile = os.path.abspath(
-                            os.path.join(
-                                os.path.dirname(filename),
-                                include))
-                    (cfg, rep) = _internal_include_handler(includefile)
-                    configs.extend(cfg)
-                    missing_repos.extend(rep)
-                elif isinstance(include, collections.Mapping):
-                    includerepo = include.get('repo', None)
-                    if includerepo is not None:
-                        includedir = repos.get(includerepo, None)
-                    else:
-                        raise IncludeException(
-                            '"repo" is not specified: {}'
-                            .format(include))
-                    if includedir is not None:
-                        try:
-                            includefile = include['file']
-                        except KeyError:
-                            raise IncludeException(
-                                '"file" is not specified: {}'
-                                .format(include))
-                        (cfg, rep) = _internal_include_handler(
-                            os.path.abspath(
-                                os.path.join(
-                                    includedir,
-                                    includefile)))
-                        configs.extend(cfg)
-                        missing_repos.extend(rep)
-                    else:
-                        missing_repos.append(includerepo)
-            configs.append((filename, current_config))
-            return (configs, missing_repos)
-
-        def _internal_dict_merge(dest, upd, recursive_merge=True):
-            """
-            Merges upd recursively into a copy of dest as OrderedDict
+                (includefile, includerepo) = _resolve_include(
+                    filename, include, repos)
+                if includefile:
+                    includes.append(includefile)
+                    _internal_include_handler(includefile)
+                elif includerepo and includerepo not in missing_repos:
+                    missing_repos.append(includerepo)
+
+            in_progress.remove(filename)
+            nodes[filename] = (current_config, includes)
+
+        _internal_include_handler(self.top_file)
+        config = _merge_configs([nodes[filename][0] for filename
+                                 in _merge_order(self.top_file, nodes)])
+        return config, missing_repos
 
-            If recursive_merge=False, will use the classic dict.update,
-            or fall back on a manual merge (helpful for non-dict types
-            like FunctionWrapper)
-            """
-            if (not isinstance(dest, collections.Mapping)) \
-                    or (not isinstance(upd, collections.Mapping)):
-                raise IncludeException('Cannot merge using non-dict')
-            dest = collections.OrderedDict(dest)
-            updkeys = list(upd.keys())
-            if not set(list(dest.keys())) & set(updkeys):
-                recursive_merge = False
-            if recursive_merge:
-                for key in updkeys:
-                    val = upd[key]
-                    try:
-                        dest_subkey = dest.get(key, None)
-                    except AttributeError:
-                        dest_subkey = None
-                    if isinstance(dest_subkey, collections.Mapping) \
-                            and isinstance(val, collections.Mapping):
-                        ret = _internal_dict_merge(dest_subkey, val)
-                        dest[key] = ret
-                    else:
-                        dest[key] = upd[key]
-                return dest
+
+def _resolve_include(filename, include, repos):
+    """
+        Returns the absolute path of the file that `filename` includes with
+        the `include` entry, and None and the name of the repo if it is
+        included from a repo that is not available yet.
+    """
+    if isinstance(include, str):
+        includefile = ''
+        if include.startswith(os.path.pathsep):
+            includefile = include
+        else:
+            includefile = os.path.abspath(
+                os.path.join(
+                    os.path.dirname(filename),
+                    include))
+        return (includefile, None)
+    if isinstance(include, collections.Mapping):
+        includerepo = include.get('repo', None)
+        if includerepo is not None:
+            includedir = repos.get(includerepo, None)
+        else:
+            raise IncludeException(
+                '"repo" is not specified: {}'
+                .format(include))
+        if includedir is None:
+            return (None, includerepo)
+        try:
+            includefile = include['file']
+        except KeyError:
+            raise IncludeException(
+                '"file" is not specified: {}'
+                .format(include))
+        return (os.path.abspath(
+            os.path.join(
+                includedir,
+                includefile)), None)
+    return (None, None)
+
+
+def _merge_order(top_file, nodes):
+    """
+        Returns the files of the include graph `nodes` in the order in
+        which they are merged.
+
+        Reading the includes depth first lists a file once for every path
+        on which it is reached. Only the last of these occurrences is kept,
+        so every file is merged once and still overrides everything that
+        came before its last occurrence.
+    """
+    # The last occurrences are the first ones of the reversed order, which
+    # lists every file before its includes and the includes from last to
+    # first. A file that was listed already is skipped together with its
+    # includes, they were all listed with it.
+    order = []
+    listed = set()
+    stack = [top_file]
+    while stack:
+        filename = stack.pop()
+        if filename in listed:
+            continue
+        listed.add(filename)
+        order.append(filename)
+        stack.extend(nodes[filename][1])
+    order.reverse()
+    return order
+
+
+def _merge_configs(configs):
+    """
+        Merges the configurations from first to last into a new OrderedDict.
+        Later configurations overwrite earlier ones, mappings are merged
+        recursively.
+
+        The parsed configurations are never modified. A mapping is only
+        copied when something has to be merged into it for the first time,
+        all later merges update that copy in place.
+    """
+    # Maps the ids of the mappings that were created here to the mappings
+    # themselves. Those can be updated in place, all others are shared with
+    # the parsed configurations.
+    owned = {}
+
+    def _own(mapping):
+        mapping = collections.OrderedDict(mapping)
+        owned[id(mapping)] = mapping
+        return mapping
+
+    def _merge(dest, upd):
+        if (not isinstance(dest, collections.Mapping)) \
+                or (not isinstance(upd, collections.Mapping)):
+            raise IncludeException('Cannot merge using non-dict')
+        for key in list(upd.keys()):
+            val = upd[key]
+            dest_subkey = dest.get(key, None)
+            if isinstance(dest_subkey, collections.Mapping) \
+                    and isinstance(val, collections.Mapping):
+                if id(dest_subkey) not in owned:
+                    dest_subkey = _own(dest_subkey)
+                    dest[key] = dest_subkey
+                _merge(dest_subkey, val)
             else:
-                try:
-                    for k in upd:
-                        dest[k] = upd[k]
-                except AttributeError:
-                    # this mapping is not a dict
-                    for k in upd:
-                        dest[k] = upd[k]
-                return dest
-
-        configs, missing_repos = _internal_include_handler(self.top_file)
-        config = functools.reduce(_internal_dict_merge,
-                                  map(lambda x: x[1], configs))
-        return config, missing_repos
+                dest[key] = val
+
+    config = _own(configs[0])
+    for upd in configs[1:]:
+        _merge(config, upd)
+    return config
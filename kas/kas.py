@@ -28,10 +28,10 @@
 
 import argparse
 import traceback
+import collections
 import logging
 import sys
 import os
-import pkg_resources
 
 try:
     import colorlog
@@ -39,8 +39,8 @@ try:
 except ImportError:
     HAVE_COLORLOG = False
 
-from .build import Build
-from .shell import Shell
+from .plugins import BUILTIN_PLUGINS, get_entry_points, load_plugin
+from .trace import close_trace_file
 from . import __version__
 
 __license__ = 'MIT'
@@ -72,6 +72,37 @@ def create_logger():
     return logging.getLogger(__name__)
 
 
+def get_selected_command(argv):
+    """
+        Returns the name of the sub command in `argv` or None.
+    """
+    for arg in argv:
+        if not arg.startswith('-'):
+            return arg
+    return None
+
+
+def select_plugins(argv):
+    """
+        Returns the 'module:attr' values of the plugins that have to be
+        loaded for `argv` and the names of the sub commands that are only
+        added to the parser, without loading their plugin.
+    """
+    cmd = get_selected_command(argv)
+    if cmd in BUILTIN_PLUGINS:
+        return ([BUILTIN_PLUGINS[cmd]],
+                [name for name in BUILTIN_PLUGINS if name != cmd])
+
+    plugins = collections.OrderedDict(sorted(BUILTIN_PLUGINS.items()))
+    plugins.update(get_entry_points())
+    if cmd is None:
+        return ([], list(plugins))
+    if cmd in plugins:
+        return ([plugins[cmd]], [name for name in plugins if name != cmd])
+    # The entry point name is not necessarily the name of the sub command
+    return (list(plugins.values()), [])
+
+
 def kas(argv):
     """
         The main entry point of kas.
@@ -88,11 +119,10 @@ def kas(argv):
                         help='Enable debug logging')
 
     subparser = parser.add_subparsers(help='sub command help', dest='cmd')
-    sub_cmds = [Build(subparser), Shell(subparser)]
-
-    for plugin in pkg_resources.iter_entry_points('kas.plugins'):
-        cmd = plugin.load()
-        sub_cmds.append(cmd(subparser))
+    (plugins, unloaded) = select_plugins(argv)
+    sub_cmds = [load_plugin(plugin)(subparser) for plugin in plugins]
+    for name in unloaded:
+        subparser.add_parser(name)
 
     args = parser.parse_args(argv)
 
@@ -118,6 +148,12 @@ def main():
         logging.error('%s', err)
         traceback.print_exc()
         sys.exit(1)
+    finally:
+        # The event loop can only exist if libkas was imported
+        libkas = sys.modules.get('kas.libkas')
+        if libkas:
+            libkas.close_loop()
+        close_trace_file()
 
 
 if __name__ == '__main__':
@@ -27,8 +27,15 @@ import tempfile
 import logging
 import shutil
 import os
+import json
+import hashlib
+import contextlib
+from .cmdlog import set_step, set_log_dir
+from .trace import trace_span, set_trace_file
 from .libkas import (ssh_cleanup_agent, ssh_setup_agent, ssh_no_host_key_check,
-                     get_build_environ, repo_fetch, repo_checkout)
+                     get_build_environ, repos_fetch, repo_checkout,
+                     update_file, is_commit_id)
+from .gitrefs import resolve_head
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
@@ -37,9 +44,14 @@ __copyright__ = 'Copyright (c) Siemens AG, 2017'
 class Macro:
     """
         Contains commands and provide method to run them.
+
+        Commands that provide their stamp inputs are skipped if their inputs
+        did not change since they last completed, unless `force` is passed
+        to `run`.
     """
     def __init__(self):
         self.commands = []
+        self._force = False
 
     def add(self, command):
         """
@@ -47,32 +59,114 @@ class Macro:
         """
         self.commands.append(command)
 
-    def run(self, config, skip=None):
+    def run(self, config, skip=None, force=False):
         """
             Runs command from the command list respective to the configuration.
         """
         skip = skip or []
+        self._force = force
         for command in self.commands:
             command_name = str(command)
             if command_name in skip:
                 continue
+            self._run_command(config, command, command_name)
+
+    def _run_command(self, config, command, command_name):
+        """
+            Runs a command together with its hooks, unless its stamp shows
+            that it is up to date.
+        """
+        with trace_span(command_name, 'command') as trace_args:
+            # Hooks can do anything, so commands with hooks are never skipped
+            stamped = not _has_hooks(config, command_name)
+            stamp_file = os.path.join(config.build_dir, '.kas_stamps',
+                                      command_name + '.stamp')
+            if stamped and not self._force:
+                stamp = _stamp_hash(config, command)
+                if stamp and _read_stamp(stamp_file) == stamp:
+                    logging.info('Skipping %s, its inputs did not change '
+                                 'since it last completed', command_name)
+                    trace_args['skipped'] = True
+                    return
+            if os.path.exists(stamp_file):
+                os.remove(stamp_file)
+
+            self._run_command_hooks(config, command, command_name)
+
+            if stamped:
+                stamp = _stamp_hash(config, command)
+                if stamp:
+                    os.makedirs(os.path.dirname(stamp_file), exist_ok=True)
+                    update_file(stamp_file, stamp + '\n')
+
+    @staticmethod
+    def _run_command_hooks(config, command, command_name):
+        """
+            Runs a command together with its hooks.
+        """
+        set_step(command_name + '_prepend')
+        with _hook_span(config, command_name + '_prepend'):
             pre_hook = config.pre_hook(command_name)
             if pre_hook:
                 logging.debug('execute %s', pre_hook)
                 pre_hook(config)
-            command_hook = config.get_hook(command_name)
-            if command_hook:
-                logging.debug('execute %s', command_hook)
+        set_step(command_name)
+        command_hook = config.get_hook(command_name)
+        if command_hook:
+            logging.debug('execute %s', command_hook)
+            with trace_span(command_name, 'hook'):
                 command_hook(config)
-            else:
-                logging.debug('execute %s', command_name)
-                command.execute(config)
+        else:
+            logging.debug('execute %s', command_name)
+            command.execute(config)
+        set_step(command_name + '_append')
+        with _hook_span(config, command_name + '_append'):
             post_hook = config.post_hook(command_name)
             if post_hook:
                 logging.debug('execute %s', post_hook)
                 post_hook(config)
 
 
+def _stamp_hash(config, command):
+    """
+        Returns the hash of the stamp inputs of the command or None if it
+        does not provide any.
+    """
+    inputs = command.stamp_inputs(config)
+    if inputs is None:
+        return None
+    return hashlib.sha256(
+        json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+
+def _read_stamp(stamp_file):
+    """
+        Returns the hash recorded in a stamp file or None.
+    """
+    try:
+        with open(stamp_file) as fds:
+            return fds.read().strip()
+    except OSError:
+        return None
+
+
+def _has_hooks(config, command_name):
+    """
+        Returns True if any hook is defined for the command.
+    """
+    return any(config.has_hook(command_name + suffix)
+               for suffix in ['_prepend', '', '_append'])
+
+
+def _hook_span(config, hook_name):
+    """
+        Returns a trace span for `hook_name` if it is defined.
+    """
+    if config.has_hook(hook_name):
+        return trace_span(hook_name, 'hook')
+    return contextlib.ExitStack()
+
+
 class Command:
     """
         An abstract class that defines the interface of a command.
@@ -84,6 +178,18 @@ class Command:
         """
         pass
 
+    def stamp_inputs(self, config):
+        """
+            Returns a JSON serializable value that describes everything the
+            result of this command depends on, or None if the command has to
+            run every time. It is evaluated after the command completed and
+            again before the next run. If both values are equal, the
+            command is skipped.
+        """
+        # pylint: disable=no-self-use,unused-argument
+
+        return None
+
 
 class SetupHome(Command):
     """
@@ -180,47 +286,123 @@ class WriteConfig(Command):
         return 'write_config'
 
     def execute(self, config):
-        def _write_bblayers_conf(config):
-            filename = config.build_dir + '/conf/bblayers.conf'
-            with open(filename, 'w') as fds:
-                fds.write(config.get_bblayers_conf_header())
-                fds.write('BBLAYERS ?= " \\\n')
-                for repo in config.get_repos():
-                    fds.write(' \\\n'.join(repo.layers + ['']))
-                fds.write('"\n')
-
-        def _write_local_conf(config):
-            filename = config.build_dir + '/conf/local.conf'
-            with open(filename, 'w') as fds:
-                fds.write(config.get_local_conf_header())
-                fds.write('MACHINE ?= "{}"\n'.format(config.get_machine()))
-                fds.write('DISTRO ?= "{}"\n'.format(config.get_distro()))
-
-        _write_bblayers_conf(config)
-        _write_local_conf(config)
+        def _bblayers_conf(config):
+            content = config.get_bblayers_conf_header()
+            content += 'BBLAYERS ?= " \\\n'
+            for repo in config.get_repos():
+                content += ' \\\n'.join(repo.layers + [''])
+            content += '"\n'
+            return content
+
+        def _local_conf(config):
+            content = config.get_local_conf_header()
+            content += 'MACHINE ?= "{}"\n'.format(config.get_machine())
+            content += 'DISTRO ?= "{}"\n'.format(config.get_distro())
+            return content
+
+        for (name, content) in [('bblayers.conf', _bblayers_conf(config)),
+                                ('local.conf', _local_conf(config))]:
+            filename = config.build_dir + '/conf/' + name
+            if update_file(filename, content):
+                logging.info('Updated %s', filename)
+            else:
+                logging.debug('%s is up to date', filename)
 
 
 class ReposFetch(Command):
     """
-        Fetches repositories defined in the configuration
+        Fetches repositories defined in the configuration. In pipeline mode,
+        each repository is checked out right after it has been fetched.
     """
 
+    def __init__(self, pipeline=False):
+        super().__init__()
+        self.pipeline = pipeline
+
     def __str__(self):
         return 'repos_fetch'
 
+    def stamp_inputs(self, config):
+        return _repos_stamp_inputs(config, self.pipeline, self.pipeline)
+
     def execute(self, config):
-        for repo in config.get_repos():
-            repo_fetch(config, repo)
+        repos_fetch(config, config.get_repos(), checkout=self.pipeline)
 
 
 class ReposCheckout(Command):
     """
-        Ensures that the right revision of each repo is check out.
+        Ensures that the right revision of each repo is check out. In
+        pipeline mode, this already happened during `ReposFetch`.
     """
 
+    def __init__(self, pipeline=False):
+        super().__init__()
+        self.pipeline = pipeline
+
     def __str__(self):
         return 'repos_checkout'
 
+    def stamp_inputs(self, config):
+        return _repos_stamp_inputs(config, self.pipeline, True)
+
     def execute(self, config):
+        if self.pipeline:
+            logging.debug('Repos were already checked out by repos_fetch')
+            return
         for repo in config.get_repos():
             repo_checkout(config, repo)
+
+
+def _repos_stamp_inputs(config, pipeline, checked_out):
+    """
+        Returns the stamp inputs of the repository commands or None if any
+        repository follows a branch, because new commits can show up there
+        at any time. If `checked_out` is set, None is also returned unless
+        every repository has its refspec checked out, e.g. because the
+        checkout of a dirty repository was skipped.
+    """
+    inputs = [pipeline]
+    for repo in config.get_repos():
+        if repo.git_operation_disabled:
+            inputs.append([repo.path])
+            continue
+        if not is_commit_id(repo.refspec or ''):
+            return None
+        if checked_out and resolve_head(repo.path) != repo.refspec:
+            return None
+        inputs.append([repo.url, repo.refspec, repo.path, repo.clone_mode,
+                       repo.clone_depth, os.path.isdir(repo.path)])
+    return inputs
+
+
+def add_common_arguments(parser):
+    """
+        Adds the options to `parser` that all plugins which run a `Macro`
+        understand.
+    """
+    parser.add_argument('--offline',
+                        help='Do not access the network, fail if a '
+                             'repository or refspec is not available '
+                             'locally',
+                        action='store_true')
+    parser.add_argument('--log-dir',
+                        help='Write the output of every executed command '
+                             'into a compressed file in this directory',
+                        default=os.environ.get('KAS_LOG_DIR'))
+    parser.add_argument('--trace',
+                        help='Record the time spent in every step, hook '
+                             'and command into this file (Chrome trace '
+                             'event format)',
+                        default=os.environ.get('KAS_TRACE'))
+
+
+def apply_common_arguments(args):
+    """
+        Applies the options added by `add_common_arguments`.
+    """
+    if args.offline:
+        os.environ['KAS_OFFLINE'] = '1'
+    if args.log_dir:
+        set_log_dir(args.log_dir)
+    if args.trace:
+        set_trace_file(args.trace)
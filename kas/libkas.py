@@ -26,58 +26,113 @@
 import re
 import os
 import sys
+import json
+import shutil
+import filecmp
+import hashlib
 import logging
 import tempfile
 import asyncio
+import codecs
+import collections
 from subprocess import Popen, PIPE
+from .cmdlog import open_command_log
+from .mirrors import MirrorCache
+from .gitrefs import resolve_head
+from .trace import trace_span
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
+# Number of stderr lines that are kept for the error message of a failed
+# command.
+ERROR_TAIL_LINES = 100
+
+# Size of the chunks in which the output of commands is read.
+READ_CHUNK_SIZE = 256 * 1024
+
+# Result of repo_is_dirty_async for each repo path
+_DIRTY_REPOS = {}
+
 
 class LogOutput:
     """
         Handles the log output of executed applications
+
+        stdout is only kept if `capture` is set. Of stderr only the last
+        `tail_lines` lines are kept, or all of them if `tail_lines` is None.
+        If `spill_file` is set, every line of both streams is written to
+        that file as well. The same applies to `cmdlog`, a
+        `kas.cmdlog.CommandLog`.
     """
-    def __init__(self, live):
+    # pylint: disable=too-many-arguments
+
+    def __init__(self, live, prefix='', capture=True, tail_lines=None,
+                 spill_file=None, cmdlog=None):
         self.live = live
-        self.stdout = []
-        self.stderr = []
+        self.prefix = prefix
+        self.stdout = [] if capture else None
+        self.stderr = collections.deque(maxlen=tail_lines)
+        self.stderr_lines = 0
+        self.spill_file = spill_file
+        self._spill = open(spill_file, 'a') if spill_file else None
+        self.cmdlog = cmdlog
 
     def log_stdout(self, line):
         """
             This method is called when a line over stdout is received.
         """
         if self.live:
-            logging.info(line.strip())
-        self.stdout.append(line)
+            logging.info('%s%s', self.prefix, line.strip())
+        if self.stdout is not None:
+            self.stdout.append(line)
+        if self._spill:
+            self._spill.write(line)
+        if self.cmdlog:
+            self.cmdlog.write('stdout', line)
 
     def log_stderr(self, line):
         """
             This method is called when a line over stderr is received.
         """
         if self.live:
-            logging.error(line.strip())
+            logging.error('%s%s', self.prefix, line.strip())
         self.stderr.append(line)
+        self.stderr_lines += 1
+        if self._spill:
+            self._spill.write(line)
+        if self.cmdlog:
+            self.cmdlog.write('stderr', line)
+
+    def close(self):
+        """
+            Closes the spill file.
+        """
+        if self._spill:
+            self._spill.close()
+            self._spill = None
 
 
 @asyncio.coroutine
 def _read_stream(stream, callback):
     """
         This asynchronious method reads from the output stream of the
-        application and transfers each line to the callback function.
+        application in chunks and transfers each line to the callback
+        function. Lines can be of any length, bytes that are not valid
+        UTF-8 are replaced.
     """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending = ''
     while True:
-        line = yield from stream.readline()
-        try:
-            line = line.decode('utf-8')
-        except UnicodeDecodeError as err:
-            logging.warning('Could not decode line from stream, ignore it: %s',
-                            err)
-        if line:
-            callback(line)
-        else:
+        data = yield from stream.read(READ_CHUNK_SIZE)
+        lines = (pending + decoder.decode(data, final=not data)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            callback(line + '\n')
+        if not data:
             break
+    if pending:
+        callback(pending)
 
 
 @asyncio.coroutine
@@ -93,7 +148,6 @@ def _stream_subprocess(cmd, cwd, env, shell, stdout_cb, stderr_cb):
             cmd,
             env=env,
             cwd=cwd,
-            universal_newlines=True,
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE)
     else:
@@ -104,49 +158,159 @@ def _stream_subprocess(cmd, cwd, env, shell, stdout_cb, stderr_cb):
             stdout=asyncio.subprocess.PIPE,
             stderr=asyncio.subprocess.PIPE)
 
-    yield from asyncio.wait([
+    yield from asyncio.gather(
         _read_stream(process.stdout, stdout_cb),
-        _read_stream(process.stderr, stderr_cb)
-    ])
+        _read_stream(process.stderr, stderr_cb))
     ret = yield from process.wait()
     return ret
 
 
-def run_cmd(cmd, cwd, env=None, fail=True, shell=False, liveupdate=True):
+def get_event_loop():
+    """
+        Returns the event loop that is shared by all commands of this kas
+        invocation. It is created on first use and closed by `close_loop`.
+    """
+    loop = asyncio.get_event_loop()
+    if loop.is_closed():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+    return loop
+
+
+def close_loop():
+    """
+        Closes the event loop shared by all commands of this kas invocation.
+    """
+    loop = asyncio.get_event_loop()
+    if not loop.is_closed():
+        loop.close()
+
+
+def _run_coroutine(coro):
+    """
+        Runs the coroutine to completion on the shared event loop and
+        returns its result.
+    """
+    return get_event_loop().run_until_complete(coro)
+
+
+@asyncio.coroutine
+def run_cmd_async(cmd, cwd, env=None, fail=True, shell=False,
+                  liveupdate=True, logprefix='', capture=True,
+                  spill_file=None):
     """
-        Starts a command.
+        Starts a command asynchronously. Every line of output is logged
+        with `logprefix` in front of it. In contrast to `run_cmd` a failing
+        command does not terminate kas, its return code is passed to the
+        caller instead.
+
+        If `capture` is not set, stdout is not kept in memory and None is
+        returned instead of it. The complete output of the command is
+        appended to `spill_file` if it is set.
     """
     # pylint: disable=too-many-arguments
 
     env = env or {}
-    retc = 0
     cmdstr = cmd
     if not shell:
         cmdstr = ' '.join(cmd)
-    logging.info('%s$ %s', cwd, cmdstr)
+    logging.info('%s%s$ %s', logprefix, cwd, cmdstr)
 
-    logo = LogOutput(liveupdate)
-    if asyncio.get_event_loop().is_closed():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+    cmdlog = open_command_log(cmdstr, cwd)
+    logo = LogOutput(liveupdate, logprefix, capture=capture,
+                     tail_lines=ERROR_TAIL_LINES, spill_file=spill_file,
+                     cmdlog=cmdlog)
+    retc = None
+    if shell:
+        name = cmdstr.split(' ', 1)[0]
     else:
-        loop = asyncio.get_event_loop()
-
-    retc = loop.run_until_complete(
-        _stream_subprocess(cmd, cwd, env, shell,
-                           logo.log_stdout, logo.log_stderr))
-    loop.close()
+        name = ' '.join([os.path.basename(cmd[0])] + cmd[1:2])
+    with trace_span(name, 'run_cmd', cmdline=cmdstr, cwd=cwd) as trace_args:
+        try:
+            retc = yield from _stream_subprocess(cmd, cwd, env, shell,
+                                                 logo.log_stdout,
+                                                 logo.log_stderr)
+        finally:
+            logo.close()
+            if cmdlog:
+                cmdlog.close(retc)
+            trace_args['retc'] = retc
 
     if retc and fail:
-        msg = 'Command "{cwd}$ {cmd}" failed\n'.format(cwd=cwd, cmd=cmdstr)
+        msg = '{prefix}Command "{cwd}$ {cmd}" failed\n'.format(
+            prefix=logprefix, cwd=cwd, cmd=cmdstr)
+        if logo.stderr_lines > len(logo.stderr):
+            msg += '(last {} of {} lines of error output)\n'.format(
+                len(logo.stderr), logo.stderr_lines)
         for line in logo.stderr:
             msg += line
+        if spill_file:
+            msg += 'Complete output: {}\n'.format(spill_file)
         logging.error(msg)
-        sys.exit(retc)
 
+    if not capture:
+        return (retc, None)
     return (retc, ''.join(logo.stdout))
 
 
+def run_cmd(cmd, cwd, env=None, fail=True, shell=False, liveupdate=True,
+            capture=True, spill_file=None):
+    """
+        Starts a command synchronously. This is a wrapper around
+        `run_cmd_async` that terminates kas if the command fails and `fail`
+        is set.
+    """
+    # pylint: disable=too-many-arguments
+
+    (retc, output) = _run_coroutine(
+        run_cmd_async(cmd, cwd, env, fail, shell, liveupdate,
+                      capture=capture, spill_file=spill_file))
+
+    if retc and fail:
+        sys.exit(retc)
+
+    return (retc, output)
+
+
+def update_file(filename, content):
+    """
+        Atomically replaces `filename` with `content`, but only if its
+        current content differs. Returns True if the file was changed.
+        Unchanged files keep their mtime, so that bitbake does not need to
+        reparse them.
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    (tmp_fd, tmpname) = tempfile.mkstemp(
+        dir=dirname, prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(tmp_fd, 'w') as fds:
+            fds.write(content)
+        if os.path.isfile(filename) and \
+                filecmp.cmp(tmpname, filename, shallow=False):
+            return False
+        if os.path.exists(filename):
+            shutil.copymode(filename, tmpname)
+        else:
+            os.chmod(tmpname, 0o666 & ~_UMASK)
+        os.replace(tmpname, filename)
+        tmpname = None
+        return True
+    finally:
+        if tmpname:
+            os.remove(tmpname)
+
+
+def _get_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Reading the umask changes it for a moment in the whole process, so this
+# must not happen while other threads create files
+_UMASK = _get_umask()
+
+
 def find_program(paths, name):
     """
         Find a file within the paths array and returns its path.
@@ -158,98 +322,415 @@ def find_program(paths, name):
     return None
 
 
-def repo_fetch(config, repo):
+@asyncio.coroutine
+def repo_fetch_async(config, repo):
     """
-        Fetches the repository to the kas_work_dir.
+        Fetches the repository to the kas_work_dir. Returns 0 on success,
+        otherwise the return code of the failed git command.
     """
-    if repo.git_operation_disabled:
-        return
+    if repo.git_operation_disabled or config.is_offline():
+        return 0
+
+    logprefix = '[{}] '.format(repo.name)
 
     if not os.path.exists(repo.path):
-        os.makedirs(os.path.dirname(repo.path), exist_ok=True)
+        retc = yield from _repo_clone_async(config, repo, logprefix)
+        # A shallow clone may not contain the commit of the refspec yet
+        if retc or repo.clone_mode != 'shallow' or \
+                not is_commit_id(repo.refspec or ''):
+            return retc
+
+    # Nothing to do if the repository did not change since the last
+    # checkout of the refspec
+    if config.get_repo_state().is_current(repo):
+        return 0
+
+    # Does refspec in the current repository?
+    (retc, output) = yield from run_cmd_async(['/usr/bin/git', 'cat-file',
+                                               '-t', repo.refspec],
+                                              env=config.environ,
+                                              cwd=repo.path, fail=False,
+                                              logprefix=logprefix)
+    if retc == 0:
+        return 0
+
+    # No it is missing, try to fetch just the refspec
+    (objects_before, size_before) = \
+        yield from _repo_object_stats(config, repo, logprefix)
+    for fetch_refspec in _fetch_refspecs(repo.refspec):
+        (retc, output) = yield from run_cmd_async(['/usr/bin/git', 'fetch',
+                                                   '-q'] +
+                                                  _clone_options(repo) +
+                                                  [repo.url, fetch_refspec],
+                                                  env=config.environ,
+                                                  cwd=repo.path, fail=False,
+                                                  liveupdate=False,
+                                                  logprefix=logprefix)
+        if retc == 0:
+            break
+    else:
+        logging.info('Could not fetch %s of repository %s directly, '
+                     'fetching all refs', repo.refspec, repo.name)
+        (retc, output) = yield from run_cmd_async(['/usr/bin/git',
+                                                   'fetch', '--all'],
+                                                  env=config.environ,
+                                                  cwd=repo.path, fail=False,
+                                                  logprefix=logprefix)
+        if retc:
+            logging.warning('Could not update repository %s: %s',
+                            repo.name, output)
+            return 0
+
+    (objects_after, size_after) = \
+        yield from _repo_object_stats(config, repo, logprefix)
+    logging.info('Repository %s: fetched %d objects (%.1f MiB)',
+                 repo.name, max(objects_after - objects_before, 0),
+                 max(size_after - size_before, 0) / (1024 * 1024))
+    return 0
+
+
+@asyncio.coroutine
+def _repo_clone_async(config, repo, logprefix):
+    """
+        Clones the repository, using a reference repository if available.
+        Returns the return code of git clone.
+    """
+    os.makedirs(os.path.dirname(repo.path), exist_ok=True)
+    mirrors = None
+    mirror_lock = None
+    if config.get_repo_ref_dir() and config.get_repo_ref_dir_managed():
+        mirrors = MirrorCache(config.get_repo_ref_dir(),
+                              config.get_repo_ref_dir_max_size())
+        (gitsrcdir, mirror_lock) = \
+            yield from _mirror_update_async(config, mirrors, repo,
+                                            logprefix)
+    else:
         gitsrcdir = os.path.join(config.get_repo_ref_dir() or '',
                                  repo.qualified_name)
-        logging.debug('Looking for repo ref dir in %s', gitsrcdir)
-        if config.get_repo_ref_dir() and os.path.exists(gitsrcdir):
-            run_cmd(['/usr/bin/git',
-                     'clone',
-                     '--reference', gitsrcdir,
-                     repo.url, repo.path],
-                    env=config.environ,
-                    cwd=config.kas_work_dir)
+    logging.debug('Looking for repo ref dir in %s', gitsrcdir)
+    if not config.get_repo_ref_dir() or not os.path.exists(gitsrcdir):
+        gitsrcdir = None
+    # Managed mirrors are pruned and evicted, clones must not depend on them
+    dissociate = mirrors is not None
+    cmd = _clone_cmd(repo, gitsrcdir, dissociate)
+    try:
+        (retc, _) = yield from run_cmd_async(cmd,
+                                             env=config.environ,
+                                             cwd=config.kas_work_dir,
+                                             logprefix=logprefix)
+    finally:
+        if mirror_lock is not None:
+            mirrors.unlock(mirror_lock)
+    return retc
+
+
+@asyncio.coroutine
+def _mirror_update_async(config, mirrors, repo, logprefix):
+    """
+        Creates or updates the mirror of the repo in the managed repo ref
+        dir and evicts old mirrors if necessary. Returns the path of the
+        mirror and its lock, which is shared once the mirror is up to date
+        and has to be released after cloning.
+    """
+    mirror = mirrors.mirror_path(repo)
+    lock = yield from mirrors.lock(mirror)
+    try:
+        if os.path.exists(mirror):
+            (retc, _) = yield from run_cmd_async(['/usr/bin/git', 'remote',
+                                                  'update', '--prune'],
+                                                 env=config.environ,
+                                                 cwd=mirror, fail=False,
+                                                 logprefix=logprefix)
         else:
-            run_cmd(['/usr/bin/git', 'clone', '-q', repo.url,
-                     repo.path],
-                    env=config.environ,
-                    cwd=config.kas_work_dir)
-        return
+            tmpdir = mirror + '.tmp'
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            (retc, _) = yield from run_cmd_async(['/usr/bin/git', 'clone',
+                                                  '--mirror', '-q',
+                                                  repo.url, tmpdir],
+                                                 env=config.environ,
+                                                 cwd=config.kas_work_dir,
+                                                 fail=False,
+                                                 logprefix=logprefix)
+            if retc == 0:
+                os.rename(tmpdir, mirror)
+        if retc:
+            logging.warning('Could not update mirror of repository %s',
+                            repo.name)
+        mirrors.touch(mirror)
+        mirrors.evict(keep=[mirror])
+        yield from mirrors.share(lock)
+    except BaseException:
+        mirrors.unlock(lock)
+        raise
+    return (mirror, lock)
+
+
+def is_commit_id(refspec):
+    """
+        Returns True if `refspec` is a full commit id.
+    """
+    return re.match(r'^[0-9a-f]{40}$', refspec) is not None
 
-    # Does refspec in the current repository?
-    (retc, output) = run_cmd(['/usr/bin/git', 'cat-file',
-                              '-t', repo.refspec], env=config.environ,
-                             cwd=repo.path, fail=False)
+
+def _clone_options(repo):
+    """
+        Returns the options of git clone and git fetch that implement the
+        clone mode of the repository.
+    """
+    if repo.clone_mode == 'shallow':
+        return ['--depth', str(repo.clone_depth)]
+    if repo.clone_mode == 'blobless':
+        return ['--filter=blob:none']
+    if repo.clone_mode == 'treeless':
+        return ['--filter=tree:0']
+    return []
+
+
+def _clone_cmd(repo, reference, dissociate):
+    """
+        Returns the git clone command for the repository. `reference` is
+        the repository that is used as reference or None. If `dissociate`
+        is set, the clone does not keep using the objects of `reference`.
+    """
+    cmd = ['/usr/bin/git', 'clone'] + _clone_options(repo)
+    if repo.clone_mode == 'shallow' and repo.refspec and \
+            not is_commit_id(repo.refspec):
+        cmd.extend(['--branch', repo.refspec])
+    if reference:
+        cmd.extend(['--reference', reference])
+        if dissociate:
+            cmd.append('--dissociate')
+    else:
+        cmd.append('-q')
+    return cmd + [repo.url, repo.path]
+
+
+def _fetch_refspecs(refspec):
+    """
+        Returns the refspecs that are tried in this order to fetch just
+        `refspec` from the remote repository.
+    """
+    if is_commit_id(refspec):
+        return [refspec]
+    if refspec.startswith('refs/'):
+        return ['+{0}:{0}'.format(refspec)]
+    return ['+refs/heads/{0}:refs/remotes/origin/{0}'.format(refspec),
+            '+refs/tags/{0}:refs/tags/{0}'.format(refspec)]
+
+
+@asyncio.coroutine
+def _repo_object_stats(config, repo, logprefix=''):
+    """
+        Returns the number of objects and their size in bytes that are
+        stored in the repository.
+    """
+    (retc, output) = yield from run_cmd_async(['/usr/bin/git',
+                                               'count-objects', '-v'],
+                                              env=config.environ,
+                                              cwd=repo.path, fail=False,
+                                              liveupdate=False,
+                                              logprefix=logprefix)
+    stats = {}
     if retc == 0:
-        return
+        for line in output.splitlines():
+            (key, _, val) = line.partition(':')
+            try:
+                stats[key] = int(val)
+            except ValueError:
+                pass
+    return (stats.get('count', 0) + stats.get('in-pack', 0),
+            (stats.get('size', 0) + stats.get('size-pack', 0)) * 1024)
 
-    # No it is missing, try to fetch
-    (retc, output) = run_cmd(['/usr/bin/git', 'fetch', '--all'],
-                             env=config.environ,
-                             cwd=repo.path, fail=False)
-    if retc:
-        logging.warning('Could not update repository %s: %s',
-                        repo.name, output)
 
+@asyncio.coroutine
+def repo_verify_async(config, repo):
+    """
+        Checks without network access that the repository and its refspec
+        are available locally. Returns None if they are, otherwise a
+        description of what is missing.
+    """
+    if repo.git_operation_disabled:
+        return None
 
-def repo_checkout(config, repo):
+    if not os.path.exists(repo.path):
+        return '{}: repository {} is missing'.format(repo.name, repo.path)
+
+    if not repo.refspec:
+        return None
+
+    for ref in [repo.refspec, 'refs/remotes/origin/' + repo.refspec]:
+        (retc, _) = yield from run_cmd_async(['/usr/bin/git', 'rev-parse',
+                                              '--verify', '-q',
+                                              ref + '^{commit}'],
+                                             env=config.environ,
+                                             cwd=repo.path, fail=False,
+                                             liveupdate=False)
+        if retc == 0:
+            return None
+
+    return '{}: refspec {} is missing'.format(repo.name, repo.refspec)
+
+
+def repo_fetch(config, repo):
     """
-        Checks out the correct revision of the repo.
+        Fetches the repository to the kas_work_dir.
+    """
+    repos_fetch(config, [repo])
+
+
+def repos_fetch(config, repos, checkout=False):
+    """
+        Fetches the list of repositories to the kas_work_dir. At most
+        `config.get_max_jobs()` repositories are fetched in parallel. In
+        offline mode, it is only verified that they are available. If
+        `checkout` is set, every repository is checked out as soon as it
+        has been fetched, independent of the other ones. If this fails for
+        any of them, all failures are reported together and kas is
+        terminated.
+    """
+    repos = list(repos)
+
+    if config.is_offline():
+        @asyncio.coroutine
+        def _verify_all():
+            return (yield from asyncio.gather(*[repo_verify_async(config, repo)
+                                                for repo in repos]))
+
+        missing = [msg for msg in _run_coroutine(_verify_all()) if msg]
+        if missing:
+            logging.error('Offline mode, but %d of %d repositories are not '
+                          'available locally:\n  %s', len(missing),
+                          len(repos), '\n  '.join(missing))
+            sys.exit(1)
+
+    @asyncio.coroutine
+    def _fetch_all():
+        semaphore = asyncio.Semaphore(config.get_max_jobs())
+
+        @asyncio.coroutine
+        def _fetch(repo):
+            yield from semaphore.acquire()
+            try:
+                retc = yield from repo_fetch_async(config, repo)
+                if retc or not checkout:
+                    return retc
+                return (yield from repo_checkout_async(config, repo))
+            finally:
+                semaphore.release()
+
+        return (yield from asyncio.gather(*[_fetch(repo)
+                                            for repo in repos]))
+
+    results = _run_coroutine(_fetch_all())
+
+    failed = [(repo, retc) for (repo, retc) in zip(repos, results) if retc]
+    if failed:
+        logging.error('%s failed for %d of %d repositories: %s',
+                      'Fetching and checkout' if checkout else 'Fetching',
+                      len(failed), len(repos),
+                      ', '.join('{} ({})'.format(repo.name, retc)
+                                for (repo, retc) in failed))
+        sys.exit(failed[0][1])
+
+
+@asyncio.coroutine
+def repo_checkout_async(config, repo):
+    """
+        Checks out the correct revision of the repo. Returns 0 on success,
+        otherwise the return code of the failed git command.
     """
     if repo.git_operation_disabled:
-        return
+        return 0
+
+    logprefix = '[{}] '.format(repo.name)
+
+    state = config.get_repo_state()
+    if state.is_current(repo):
+        logging.info('Repo %s is unchanged since its last checkout. '
+                     'nothing to do', repo.name)
+        return 0
 
     # Check if repos is dirty
-    (_, output) = run_cmd(['/usr/bin/git', 'diff', '--shortstat'],
-                          env=config.environ, cwd=repo.path,
-                          fail=False)
-    if len(output):
+    dirty = yield from repo_is_dirty_async(config, repo, logprefix)
+    if dirty:
         logging.warning('Repo %s is dirty. no checkout', repo.name)
-        return
+        return 0
 
     # Check if current HEAD is what in the config file is defined.
-    (_, output) = run_cmd(['/usr/bin/git', 'rev-parse',
-                           '--verify', 'HEAD'],
-                          env=config.environ, cwd=repo.path)
-
-    if output.strip() == repo.refspec:
+    head = resolve_head(repo.path)
+    if head is None:
+        (retc, output) = yield from run_cmd_async(['/usr/bin/git',
+                                                   'rev-parse',
+                                                   '--verify', 'HEAD'],
+                                                  env=config.environ,
+                                                  cwd=repo.path,
+                                                  logprefix=logprefix)
+        if retc:
+            return retc
+        head = output.strip()
+
+    if head == repo.refspec:
         logging.info('Repo %s has already checkout out correct '
                      'refspec. nothing to do', repo.name)
-        return
+        state.record(repo)
+        return 0
 
-    run_cmd(['/usr/bin/git', 'checkout', '-q',
-             '{refspec}'.format(refspec=repo.refspec)],
-            cwd=repo.path)
+    (retc, _) = yield from run_cmd_async(['/usr/bin/git', 'checkout', '-q',
+                                          '{refspec}'.format(
+                                              refspec=repo.refspec)],
+                                         cwd=repo.path, logprefix=logprefix)
+    if retc == 0:
+        state.record(repo)
+    return retc
 
 
-def get_build_environ(config, build_dir):
+@asyncio.coroutine
+def repo_is_dirty_async(config, repo, logprefix=''):
     """
-        Create the build environment variables.
+        Returns True if the work tree of the repo contains changes that are
+        not staged. git stops at the first change it finds, and the result
+        is remembered for the rest of the kas run.
     """
-    # pylint: disable=too-many-locals
-    # nasty side effect function: running oe/isar-init-build-env also
-    # creates the conf directory
+    if repo.path not in _DIRTY_REPOS:
+        (retc, _) = yield from run_cmd_async(['/usr/bin/git', 'diff',
+                                              '--quiet'],
+                                             env=config.environ,
+                                             cwd=repo.path, fail=False,
+                                             logprefix=logprefix)
+        _DIRTY_REPOS[repo.path] = retc == 1
+    return _DIRTY_REPOS[repo.path]
+
+
+def repo_checkout(config, repo):
+    """
+        Checks out the correct revision of the repo.
+    """
+    retc = _run_coroutine(repo_checkout_async(config, repo))
+    if retc:
+        sys.exit(retc)
 
-    permutations = \
-        [(repo, script) for repo in config.get_repos()
-         for script in ['oe-init-build-env', 'isar-init-build-env']]
-    for (repo, script) in permutations:
-        if os.path.exists(repo.path + '/' + script):
-            init_path = repo.path
-            init_script = script
-            break
-    else:
-        logging.error('Did not find any init-build-env script')
-        sys.exit(1)
 
+def _build_environ_key(config, init_path, init_script, build_dir):
+    """
+        Returns a hash over everything the environment created by the init
+        script depends on or None if it cannot be determined.
+    """
+    hasher = hashlib.sha256()
+    with open(os.path.join(init_path, init_script), 'rb') as fds:
+        hasher.update(fds.read())
+    hasher.update('\0{}\0{}\0'.format(init_script, build_dir).encode())
+    for repo in config.get_repos():
+        head = resolve_head(repo.path)
+        if head is None and os.path.exists(os.path.join(repo.path, '.git')):
+            return None
+        hasher.update('{}={}\0'.format(repo.path, head).encode())
+    return hasher.hexdigest()
+
+
+def _run_init_build_env(init_path, init_script, build_dir):
+    """
+        Sources the init script and returns the resulting environment.
+    """
     get_bb_env_file = tempfile.mktemp()
     with open(get_bb_env_file, 'w') as fds:
         script = """#!/bin/bash
@@ -275,6 +756,58 @@ def get_build_environ(config, build_dir):
         except ValueError:
             pass
 
+    return env
+
+
+def get_build_environ(config, build_dir):
+    """
+        Create the build environment variables.
+
+        The environment created by the init script is cached in the kas
+        cache dir and reused as long as the init script, the HEADs of all
+        repos and the build dir stay the same.
+    """
+    # nasty side effect function: running oe/isar-init-build-env also
+    # creates the conf directory
+
+    permutations = \
+        [(repo, script) for repo in config.get_repos()
+         for script in ['oe-init-build-env', 'isar-init-build-env']]
+    for (repo, script) in permutations:
+        if os.path.exists(repo.path + '/' + script):
+            init_path = repo.path
+            init_script = script
+            break
+    else:
+        logging.error('Did not find any init-build-env script')
+        sys.exit(1)
+
+    cache_file = os.path.join(config.cache_dir, 'build_environ.json')
+    cache_key = None
+    if os.path.isdir(os.path.join(build_dir, 'conf')):
+        cache_key = _build_environ_key(config, init_path, init_script,
+                                       build_dir)
+    env = None
+    if cache_key:
+        try:
+            with open(cache_file) as fds:
+                cache = json.load(fds)
+            if cache['key'] == cache_key:
+                logging.debug('Using cached build environment from %s',
+                              cache_file)
+                env = cache['environ']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if env is None:
+        env = _run_init_build_env(init_path, init_script, build_dir)
+        cache_key = cache_key or _build_environ_key(config, init_path,
+                                                    init_script, build_dir)
+        if cache_key:
+            os.makedirs(config.cache_dir, exist_ok=True)
+            update_file(cache_file,
+                        json.dumps({'key': cache_key, 'environ': env}))
+
     env_vars = ['SSTATE_DIR', 'DL_DIR', 'TMPDIR']
     if 'BB_ENV_EXTRAWHITE' in env:
         extra_white = env['BB_ENV_EXTRAWHITE'] + ' '.join(env_vars)
@@ -0,0 +1,171 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module manages a directory of bare git mirrors that are shared by
+    all kas instances on a host and used as references when cloning.
+"""
+
+import os
+import re
+import fcntl
+import shutil
+import asyncio
+import logging
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+def parse_size(size):
+    """
+        Converts a size like '500M' or '20G' into bytes.
+    """
+    match = re.match(r'^\s*(\d+)\s*([KMGT]?)B?\s*$', size.upper())
+    if not match:
+        raise ValueError('Invalid size: {}'.format(size))
+    exponent = ' KMGT'.index(match.group(2) or ' ')
+    return int(match.group(1)) * 1024 ** exponent
+
+
+def _dir_size(path):
+    """
+        Returns the size of all files below `path` in bytes.
+    """
+    size = 0
+    for (root, _, files) in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class MirrorCache:
+    """
+        A directory of bare mirrors, named after `Repo.qualified_name`.
+
+        Every mirror has a lock file next to it. The lock is held exclusively
+        while the mirror is created, updated or evicted, and shared while
+        the mirror is used as a reference for clones. The modification time
+        of the lock file records when the mirror was used last. If
+        `max_size` is set, the least recently used mirrors are evicted until
+        all mirrors fit into that many bytes.
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+
+    def mirror_path(self, repo):
+        """
+            Returns the path of the mirror of `repo`.
+        """
+        return os.path.join(self.path, repo.qualified_name)
+
+    @asyncio.coroutine
+    def lock(self, mirror):
+        """
+            Waits for the lock of `mirror` without blocking the event loop
+            and returns the locked file descriptor.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        lock_fd = os.open(mirror + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+        loop = asyncio.get_event_loop()
+        try:
+            yield from loop.run_in_executor(None, fcntl.flock, lock_fd,
+                                            fcntl.LOCK_EX)
+        except BaseException:
+            os.close(lock_fd)
+            raise
+        return lock_fd
+
+    @staticmethod
+    @asyncio.coroutine
+    def share(lock_fd):
+        """
+            Converts a lock returned by `lock` into a shared one, so that
+            other kas instances can clone from the mirror at the same time.
+            The conversion is not atomic, the mirror may have been evicted
+            in between.
+        """
+        loop = asyncio.get_event_loop()
+        yield from loop.run_in_executor(None, fcntl.flock, lock_fd,
+                                        fcntl.LOCK_SH)
+
+    @staticmethod
+    def unlock(lock_fd):
+        """
+            Releases a lock returned by `lock`.
+        """
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+    @staticmethod
+    def touch(mirror):
+        """
+            Marks `mirror` as used right now.
+        """
+        os.utime(mirror + '.lock', None)
+
+    def evict(self, keep):
+        """
+            Removes the least recently used mirrors until the cache fits into
+            `max_size`. Mirrors in `keep` and mirrors that are in use are
+            not removed.
+        """
+        if not self.max_size or not os.path.isdir(self.path):
+            return
+
+        mirrors = []
+        total = 0
+        for name in os.listdir(self.path):
+            mirror = os.path.join(self.path, name)
+            if name.endswith(('.lock', '.tmp')) or \
+                    not os.path.isdir(mirror):
+                continue
+            try:
+                used = os.stat(mirror + '.lock').st_mtime
+            except OSError:
+                used = 0
+            size = _dir_size(mirror)
+            total += size
+            mirrors.append((used, mirror, size))
+
+        for (_, mirror, size) in sorted(mirrors):
+            if total <= self.max_size:
+                break
+            if mirror in keep:
+                continue
+            lock_fd = os.open(mirror + '.lock', os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(lock_fd)
+                continue
+            try:
+                logging.info('Evicting repo mirror %s (%.1f MiB)', mirror,
+                             size / (1024 * 1024))
+                shutil.rmtree(mirror)
+                total -= size
+            finally:
+                self.unlock(lock_fd)
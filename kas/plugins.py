@@ -0,0 +1,130 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module finds and loads kas plugins without importing them before
+    they are needed.
+"""
+
+import os
+import sys
+import json
+import logging
+import tempfile
+import importlib
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+ENTRY_POINT_GROUP = 'kas.plugins'
+
+# The plugins that are part of kas, by the name of their sub command
+BUILTIN_PLUGINS = {
+    'build': 'kas.build:Build',
+    'shell': 'kas.shell:Shell',
+}
+
+
+def _index_file():
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.expanduser('~/.cache'))
+    return os.path.join(cache_home, 'kas', 'plugins.json')
+
+
+def _index_key():
+    """
+        Returns a value that changes whenever a distribution is installed
+        into or removed from one of the directories in sys.path.
+    """
+    key = []
+    for path in sys.path:
+        try:
+            key.append([path, os.stat(path or '.').st_mtime_ns])
+        except OSError:
+            key.append([path, None])
+    return key
+
+
+def _scan_entry_points():
+    """
+        Returns a dictionary that maps the name of every kas plugin entry
+        point to its 'module:attr' value.
+    """
+    try:
+        from importlib import metadata
+    except ImportError:
+        try:
+            import importlib_metadata as metadata
+        except ImportError:
+            metadata = None
+
+    if metadata is None:
+        import pkg_resources
+        return {ep.name: '{}:{}'.format(ep.module_name, '.'.join(ep.attrs))
+                for ep in pkg_resources.iter_entry_points(ENTRY_POINT_GROUP)}
+
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
+    else:
+        entry_points = entry_points.get(ENTRY_POINT_GROUP, [])
+    return {ep.name: ep.value for ep in entry_points}
+
+
+def get_entry_points():
+    """
+        Returns a dictionary that maps the name of every installed kas
+        plugin entry point to its 'module:attr' value.
+
+        The result is cached in the user's cache directory and only
+        scanned again if sys.path or one of its directories changed.
+    """
+    filename = _index_file()
+    key = _index_key()
+    try:
+        with open(filename) as fds:
+            index = json.load(fds)
+        if index['key'] == key:
+            return index['entry_points']
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    entry_points = _scan_entry_points()
+    try:
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        (tmp_fd, tmpname) = tempfile.mkstemp(dir=os.path.dirname(filename))
+        with os.fdopen(tmp_fd, 'w') as fds:
+            json.dump({'key': key, 'entry_points': entry_points}, fds)
+        os.replace(tmpname, filename)
+    except OSError as err:
+        logging.debug('Could not store plugin index: %s', err)
+    return entry_points
+
+
+def load_plugin(value):
+    """
+        Imports and returns the object referenced by a 'module:attr' value.
+    """
+    (module_name, _, attrs) = value.partition(':')
+    obj = importlib.import_module(module_name)
+    for attr in filter(None, attrs.split('.')):
+        obj = getattr(obj, attr)
+    return obj
@@ -29,19 +29,47 @@ from urllib.parse import urlparse
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
 
+# Supported ways to clone a repository:
+#   full     - complete history with all objects
+#   shallow  - only the last `depth` commits (git clone --depth)
+#   blobless - all commits and trees, blobs are fetched on demand
+#              (git clone --filter=blob:none)
+#   treeless - all commits, trees and blobs are fetched on demand
+#              (git clone --filter=tree:0)
+CLONE_MODES = ['full', 'shallow', 'blobless', 'treeless']
+
 
 class Repo:
     """
         Represents a repository in the kas configuration.
     """
+    # pylint: disable=too-many-arguments,too-many-instance-attributes
+
+    __slots__ = ('url', 'path', 'refspec', '_layers', 'name',
+                 'git_operation_disabled', 'clone_mode', 'clone_depth',
+                 'layers', 'qualified_name')
 
-    def __init__(self, url, path, refspec=None, layers=None):
+    def __init__(self, url, path, refspec=None, layers=None,
+                 clone_mode='full', clone_depth=1):
         self.url = url
         self.path = path
         self.refspec = refspec
         self._layers = layers
         self.name = os.path.basename(self.path)
         self.git_operation_disabled = False
+        self.clone_mode = clone_mode
+        self.clone_depth = clone_depth
+        if not self._layers:
+            self.layers = [self.path]
+        else:
+            self.layers = [self.path + '/' + layer for layer in self._layers]
+        url = urlparse(self.url)
+        self.qualified_name = ('{url.netloc}{url.path}'
+                               .format(url=url)
+                               .replace('@', '.')
+                               .replace(':', '.')
+                               .replace('/', '.')
+                               .replace('*', '.'))
 
     def disable_git_operations(self):
         """
@@ -49,21 +77,6 @@ class Repo:
         """
         self.git_operation_disabled = True
 
-    def __getattr__(self, item):
-        if item == 'layers':
-            if not self._layers:
-                return [self.path]
-            else:
-                return [self.path + '/' + l for l in self._layers]
-        elif item == 'qualified_name':
-            url = urlparse(self.url)
-            return ('{url.netloc}{url.path}'
-                    .format(url=url)
-                    .replace('@', '.')
-                    .replace(':', '.')
-                    .replace('/', '.')
-                    .replace('*', '.'))
-
     def __str__(self):
         return '%s:%s %s %s' % (self.url, self.refspec,
                                 self.path, self._layers)
@@ -0,0 +1,135 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module remembers the state of the repositories between kas runs,
+    so that git commands can be skipped for repositories that did not
+    change since then.
+"""
+
+import os
+import json
+import logging
+import tempfile
+from .gitrefs import find_git_dir, get_common_dir
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+def _stat(path):
+    """
+        Returns the modification time and size of `path` or None if it does
+        not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def fingerprint(path):
+    """
+        Returns a fingerprint of the HEAD and the index of the git
+        repository in `path` or None if it cannot be determined without
+        running git.
+    """
+    gitdir = find_git_dir(path)
+    if gitdir is None:
+        return None
+    try:
+        with open(os.path.join(gitdir, 'HEAD')) as fds:
+            head = fds.read().strip()
+    except OSError:
+        return None
+
+    commondir = get_common_dir(gitdir)
+    result = {
+        'HEAD': head,
+        'HEAD_stat': _stat(os.path.join(gitdir, 'HEAD')),
+        'index_stat': _stat(os.path.join(gitdir, 'index')),
+        'packed_refs_stat': _stat(os.path.join(commondir, 'packed-refs')),
+    }
+    if head.startswith('ref: '):
+        result['ref_stat'] = _stat(os.path.join(commondir, head[5:]))
+    return result
+
+
+class RepoStateCache:
+    """
+        A file that records for every repository the url and refspec it
+        was last checked out with and a fingerprint of its HEAD and index
+        at that time.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(self.filename) as fds:
+                self._states = json.load(fds)
+        except (OSError, ValueError):
+            self._states = {}
+
+    def is_current(self, repo):
+        """
+            Returns True if `repo` was checked out with its current url and
+            refspec and did not change since then.
+        """
+        state = self._states.get(repo.path)
+        if not state or state['url'] != repo.url or \
+                state['refspec'] != repo.refspec:
+            return False
+        if state['fingerprint'] != fingerprint(repo.path):
+            return False
+        logging.debug('Repo %s did not change since the last run',
+                      repo.name)
+        return True
+
+    def record(self, repo):
+        """
+            Records that `repo` is checked out with its refspec right now.
+        """
+        state = fingerprint(repo.path)
+        if state is None:
+            self.invalidate(repo)
+            return
+        self._states[repo.path] = {
+            'url': repo.url,
+            'refspec': repo.refspec,
+            'fingerprint': state,
+        }
+        self._save()
+
+    def invalidate(self, repo):
+        """
+            Forgets the state of `repo`.
+        """
+        if self._states.pop(repo.path, None) is not None:
+            self._save()
+
+    def _save(self):
+        dirname = os.path.dirname(self.filename)
+        os.makedirs(dirname, exist_ok=True)
+        (tmp_fd, tmpname) = tempfile.mkstemp(dir=dirname)
+        with os.fdopen(tmp_fd, 'w') as fds:
+            json.dump(self._states, fds, indent=1, sort_keys=True)
+        os.replace(tmpname, self.filename)
@@ -26,7 +26,9 @@
 
 import subprocess
 from kas.config import load_config
-from kas.libcmds import (Macro, Command, SetupProxy, SetupEnviron, SetupHome)
+from kas.trace import trace_span
+from kas.libcmds import (Macro, Command, SetupProxy, SetupEnviron, SetupHome,
+                         add_common_arguments, apply_common_arguments)
 
 __license__ = 'MIT'
 __copyright__ = 'Copyright (c) Siemens AG, 2017'
@@ -48,6 +50,7 @@ class Shell:
         sh_prs.add_argument('--skip',
                             help='Skip build steps',
                             default=[])
+        add_common_arguments(sh_prs)
         sh_prs.add_argument('-c', '--command',
                             help='Run command',
                             default='')
@@ -61,7 +64,10 @@ class Shell:
         if args.cmd != 'shell':
             return False
 
-        cfg = load_config(args.config, args.target)
+        apply_common_arguments(args)
+
+        with trace_span('load_config', 'command'):
+            cfg = load_config(args.config, args.target)
 
         macro = Macro()
 
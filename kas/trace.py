@@ -0,0 +1,183 @@
+# kas - setup tool for bitbake based projects
+#
+# Copyright (c) Siemens AG, 2017
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+    This module records the time spent in the commands, hooks and
+    subprocesses of kas in the Chrome trace event format. The resulting file
+    can be opened with chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+try:
+    from contextvars import ContextVar
+except ImportError:
+    class ContextVar:
+        """
+            Replacement for contextvars.ContextVar on Python < 3.7. Values
+            cannot be kept per asyncio task there, so it always returns the
+            default.
+        """
+
+        def __init__(self, name, default=None):
+            self.name = name
+            self._default = default
+
+        def get(self):
+            """
+                Returns the default value.
+            """
+            return self._default
+
+        def set(self, value):
+            """
+                Ignores the value.
+            """
+            # pylint: disable=unused-argument
+
+            pass
+
+__license__ = 'MIT'
+__copyright__ = 'Copyright (c) Siemens AG, 2017'
+
+
+class TraceFile:
+    """
+        A file that receives trace events as soon as they are complete.
+
+        Events are written as a JSON array. The closing bracket is optional
+        in the trace event format, so the file stays usable if kas exits
+        early. A span that is started while its parent span is the
+        innermost one on the parent's lane shares that lane. Spans that
+        overlap in time without being nested, like git commands that run
+        concurrently, are put on different lanes (shown as threads by
+        trace viewers). Without contextvars (Python < 3.7), the parent of
+        a span is not known and every span gets a lane of its own.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._lanes = []
+        self._file = open(filename, 'w')
+        self._file.write('[')
+        self._separator = '\n'
+        self._write({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                     'args': {'name': 'kas'}})
+
+    def _write(self, event):
+        self._file.write(self._separator + json.dumps(event))
+        self._file.flush()
+        self._separator = ',\n'
+
+    def _now(self):
+        return int((time.perf_counter() - self.start) * 1000000)
+
+    def begin(self, name, cat, args, parent=None):
+        """
+            Starts a span within the span `parent` and returns the token to
+            end it with.
+        """
+        with self._lock:
+            if parent and self._lanes[parent[3]] is parent:
+                lane = parent[3]
+            else:
+                try:
+                    lane = self._lanes.index(None)
+                except ValueError:
+                    lane = len(self._lanes)
+                    self._lanes.append(None)
+            token = (name, cat, args, lane, self._now(), self._lanes[lane])
+            self._lanes[lane] = token
+            return token
+
+    def end(self, token, **args):
+        """
+            Ends the span started with `begin` and writes its event.
+        """
+        (name, cat, begin_args, lane, start, parent) = token
+        event_args = dict(begin_args)
+        event_args.update(args)
+        with self._lock:
+            self._lanes[lane] = parent
+            self._write({'name': name, 'cat': cat, 'ph': 'X',
+                         'pid': os.getpid(), 'tid': lane, 'ts': start,
+                         'dur': self._now() - start, 'args': event_args})
+
+    def close(self):
+        """
+            Terminates the JSON array and closes the file.
+        """
+        with self._lock:
+            self._file.write('\n]\n')
+            self._file.close()
+
+
+_TRACE_FILE = None
+_SPAN = ContextVar('kas_trace_span', default=None)
+
+
+def set_trace_file(filename):
+    """
+        Records trace events into `filename` from now on.
+    """
+    # pylint: disable=global-statement
+    global _TRACE_FILE
+    close_trace_file()
+    _TRACE_FILE = TraceFile(filename)
+
+
+def close_trace_file():
+    """
+        Completes and closes the current trace file, if any.
+    """
+    # pylint: disable=global-statement
+    global _TRACE_FILE
+    if _TRACE_FILE:
+        _TRACE_FILE.close()
+        _TRACE_FILE = None
+
+
+@contextlib.contextmanager
+def trace_span(name, cat, **args):
+    """
+        Records the time spent in the body of the with statement as event
+        `name` of category `cat`. Yields a dictionary to which further
+        arguments of the event can be added.
+    """
+    if not _TRACE_FILE:
+        yield {}
+        return
+    trace_file = _TRACE_FILE
+    parent = _SPAN.get()
+    token = trace_file.begin(name, cat, args, parent)
+    _SPAN.set(token)
+    end_args = {}
+    try:
+        yield end_args
+    finally:
+        _SPAN.set(parent)
+        trace_file.end(token, **end_args)